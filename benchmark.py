@@ -0,0 +1,289 @@
+# Offline end-to-end benchmark for ollama_chat_app.py.
+#
+# Starts a local stand-in server for Ollama, web search, translation and TTS
+# (with configurable latency and token rates), points the app at it, and
+# drives handle_input through scripted conversations of increasing length
+# with Streamlit's AppTest. No network access is needed.
+#
+#   python benchmark.py --lengths 5,20,50 --token-rate 80
+#
+# Reports turn throughput, p50/p95 per pipeline stage (from the app's own
+# spans), full-rerun cost and memory growth per conversation length.
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+APP_FILE = Path(__file__).with_name("ollama_chat_app.py")
+WORDS = "the model answers with a few plain sentences about the question that was asked".split()
+
+
+# === Stand-in server ===
+class StandInHandler(BaseHTTPRequestHandler):
+    config = None
+    last_prompt = ""
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/search":
+            time.sleep(self.config.search_ms / 1000)
+            text = query.get("q", [""])[0]
+            items = "".join(
+                f'<div class="g"><div class="VwiC3b">Result {i} for {text}</div></div>'
+                f'<div class="dbsr"><a href="https://example.com/{i}">Headline {i}</a></div>'
+                for i in range(10)
+            )
+            self.send_body(f"<html><body>{items}</body></html>".encode("utf-8"), "text/html")
+        elif url.path == "/html/":
+            # DuckDuckGo's HTML endpoint, a little slower than the first source
+            time.sleep(self.config.search_ms * 1.5 / 1000)
+            text = query.get("q", [""])[0]
+            items = "".join(
+                f'<div class="result"><a class="result__snippet" href="https://example.org/{i}">Other result {i} for {text}</a></div>'
+                for i in range(10)
+            )
+            self.send_body(f"<html><body>{items}</body></html>".encode("utf-8"), "text/html")
+        elif url.path == "/tts":
+            time.sleep(self.config.tts_ms / 1000)
+            chars = int(query.get("chars", ["0"])[0])
+            self.send_body(b"\xff\xfb" + b"\0" * (chars * 40), "audio/mpeg")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_json()
+        if url.path == "/translate":
+            time.sleep(self.config.translate_ms / 1000)
+            self.send_body(json.dumps({"text": body.get("text", "")}).encode("utf-8"), "application/json")
+        elif url.path in ("/api/chat", "/api/generate"):
+            self.stream_ollama(url.path, body)
+        else:
+            self.send_error(404)
+
+    def stream_ollama(self, path, body):
+        # Prefill time is charged only for the part of the prompt that differs
+        # from the previous request, like Ollama's prompt-prefix cache.
+        prompt = json.dumps(body.get("messages") or body.get("prompt") or "")
+        with self.lock:
+            common = len(os.path.commonprefix([prompt, StandInHandler.last_prompt]))
+            StandInHandler.last_prompt = prompt
+        prompt_tokens = len(prompt) // 4
+        new_tokens = max(1, (len(prompt) - common) // 4)
+        prefill = new_tokens / self.config.prefill_rate
+        time.sleep(prefill)
+
+        words = [random.choice(WORDS) for _ in range(self.config.answer_tokens if body.get("messages") else 0)]
+        key = "message" if path == "/api/chat" else "response"
+        stream = body.get("stream", True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        started = time.perf_counter()
+        if stream:
+            for i, word in enumerate(words):
+                time.sleep(1 / self.config.token_rate)
+                text = (word.capitalize() if i == 0 else " " + word) + ("." if i % 12 == 11 else "")
+                chunk = {"message": {"role": "assistant", "content": text}} if key == "message" else {"response": text}
+                self.wfile.write((json.dumps({**chunk, "done": False}) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        else:
+            time.sleep(len(words) / self.config.token_rate)
+        final = {
+            "done": True,
+            "prompt_eval_count": new_tokens,
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": len(words),
+            "eval_duration": int((time.perf_counter() - started) * 1e9),
+            "total_duration": int((time.perf_counter() - started + prefill) * 1e9),
+            "prompt_tokens_total": prompt_tokens,
+        }
+        if not stream:
+            text = " ".join(words)
+            final.update({"message": {"role": "assistant", "content": text}} if key == "message" else {"response": text})
+        self.wfile.write((json.dumps(final) + "\n").encode("utf-8"))
+
+
+def start_server(config):
+    StandInHandler.config = config
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# === Library stand-ins ===
+def install_stand_ins(base_url):
+    # deep_translator and gTTS talk to Google directly; replace them with
+    # clients of the stand-in server before the app script imports them.
+    import deep_translator
+    import gtts
+
+    class StandInTranslator:
+        def __init__(self, source="auto", target="en", **kwargs):
+            self.source, self.target = source, target
+
+        def translate(self, text):
+            response = requests.post(f"{base_url}/translate", json={"text": text, "target": self.target}, timeout=10)
+            return response.json()["text"]
+
+    class StandInTTS:
+        def __init__(self, text, lang="en", **kwargs):
+            self.text = text
+
+        def write_to_fp(self, fp):
+            fp.write(requests.get(f"{base_url}/tts", params={"chars": len(self.text)}, timeout=10).content)
+
+    deep_translator.GoogleTranslator = StandInTranslator
+    gtts.gTTS = StandInTTS
+
+
+# === Driver ===
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def run_conversation(length, home, poll_interval):
+    from streamlit.testing.v1 import AppTest
+
+    # every AppTest run is a new session, so each conversation gets its own journal
+    app = AppTest.from_file(str(APP_FILE), default_timeout=120)
+    app.run()
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+
+    turn_times, rerun_times = [], []
+    memory_start = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for turn in range(length):
+        expected = len(app.session_state["messages"]) + 2
+        turn_started = time.perf_counter()
+        app.chat_input[0].set_value(f"Question {turn} about topic {random.randint(0, 10**6)}?").run()
+        while len(app.session_state["messages"]) < expected:
+            time.sleep(poll_interval)
+            app.run()
+            if app.exception:
+                raise RuntimeError(app.exception[0].message)
+        turn_times.append(time.perf_counter() - turn_started)
+
+        rerun_started = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - rerun_started)
+    elapsed = time.perf_counter() - started
+    history_bytes = (home / "sessions" / f"{app.session_state['history_id']}.jsonl").stat().st_size
+    return {
+        "length": length,
+        "turns_per_second": length / elapsed,
+        "turn_p50_ms": percentile(turn_times, 0.5) * 1000,
+        "turn_p95_ms": percentile(turn_times, 0.95) * 1000,
+        "rerun_p50_ms": percentile(rerun_times, 0.5) * 1000,
+        "rerun_p95_ms": percentile(rerun_times, 0.95) * 1000,
+        "rerun_last_ms": rerun_times[-1] * 1000 if rerun_times else 0.0,
+        "memory_growth_kb": (tracemalloc.get_traced_memory()[0] - memory_start) / 1024,
+        "history_kb": history_bytes / 1024,
+    }
+
+
+def stage_report(home):
+    spans = {}
+    metrics_dir = home / "metrics"
+    for path in sorted(metrics_dir.glob("spans.jsonl*")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                span = json.loads(line)
+                spans.setdefault(span["stage"], []).append(span["duration_ms"])
+    return {
+        stage: {"n": len(values), "p50_ms": percentile(values, 0.5), "p95_ms": percentile(values, 0.95)}
+        for stage, values in sorted(spans.items())
+    }
+
+
+def print_report(results, stages):
+    print("\nConversation length | turns/s | turn p50/p95 ms | rerun p50/p95/last ms | mem growth KB | history KB")
+    for r in results:
+        print(
+            f"{r['length']:>19} | {r['turns_per_second']:7.2f} | {r['turn_p50_ms']:7.0f} / {r['turn_p95_ms']:<6.0f}"
+            f" | {r['rerun_p50_ms']:6.1f} / {r['rerun_p95_ms']:6.1f} / {r['rerun_last_ms']:6.1f}"
+            f" | {r['memory_growth_kb']:13.0f} | {r['history_kb']:10.1f}"
+        )
+    print("\nStage            |     n |  p50 ms |  p95 ms")
+    for stage, row in stages.items():
+        print(f"{stage:<16} | {row['n']:5} | {row['p50_ms']:7.1f} | {row['p95_ms']:7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline turn-latency benchmark for the chat app.")
+    parser.add_argument("--lengths", default="5,20", help="comma-separated conversation lengths (turns)")
+    parser.add_argument("--token-rate", type=float, default=120, help="generated tokens per second")
+    parser.add_argument("--prefill-rate", type=float, default=4000, help="prompt tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=48)
+    parser.add_argument("--search-ms", type=float, default=150)
+    parser.add_argument("--translate-ms", type=float, default=80)
+    parser.add_argument("--tts-ms", type=float, default=60)
+    parser.add_argument("--backends", type=int, default=1, help="number of stand-in Ollama servers")
+    parser.add_argument("--poll-ms", type=float, default=20, help="how often the driver reruns the app while a turn runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    servers = [start_server(args) for _ in range(args.backends)]
+    base_url = servers[0][1]
+    home = Path(tempfile.mkdtemp(prefix="ollama_chat_bench_"))
+    os.environ.update({
+        "OLLAMA_CHAT_HOME": str(home),
+        "OLLAMA_CHAT_OLLAMA_URL": ",".join(url for _, url in servers),
+        "OLLAMA_CHAT_SEARCH_URL": f"{base_url}/search",
+        "OLLAMA_CHAT_SEARCH_SOURCES": f"google={base_url}/search,duckduckgo={base_url}/html/",
+        "OLLAMA_CHAT_LOCATION": "Benchmark City, Nowhere",
+    })
+    install_stand_ins(base_url)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    tracemalloc.start()
+    try:
+        results = [run_conversation(int(n), home, args.poll_ms / 1000) for n in args.lengths.split(",")]
+        stages = stage_report(home)
+    finally:
+        tracemalloc.stop()
+        for server, _ in servers:
+            server.shutdown()
+        shutil.rmtree(home, ignore_errors=True)
+
+    print_report(results, stages)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "conversations": results, "stages": stages}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,165 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import requests
 import json
 import tempfile
-from gtts import gTTS
-from deep_translator import GoogleTranslator
-import speech_recognition as sr
 import re
 import getpass
 from pathlib import Path
 from datetime import datetime
-import geocoder
-from bs4 import BeautifulSoup
 from urllib.parse import quote
 import subprocess
-import pyautogui
 import time
 import math
-import mutagen.mp3
+from array import array
+from functools import partial
+import base64
+import hashlib
+import io
+import os
+import threading
+import uuid
+import sqlite3
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # === Setup ===
 username = getpass.getuser()
-history_dir = Path.home() / ".ollama_chat_history"
+history_dir = Path(os.environ.get("OLLAMA_CHAT_HOME") or Path.home() / ".ollama_chat_history")
 history_dir.mkdir(parents=True, exist_ok=True)
-history_file = history_dir / f"{username}_chat_history.json"
+sessions_dir = history_dir / "sessions"
+sessions_dir.mkdir(parents=True, exist_ok=True)
+# single-user history from before per-session stores; moved into the archive
+legacy_history_files = [history_dir / f"{username}_chat_history.jsonl", history_dir / f"{username}_chat_history.json"]
 archive_dir = history_dir / "archive"
 archive_dir.mkdir(parents=True, exist_ok=True)
+archive_db_file = history_dir / "archive.db"
+# header an authenticating reverse proxy sets to the signed-in user, e.g.
+# X-Forwarded-User; only set this when the app can't be reached around the proxy
+USER_HEADER = os.environ.get("OLLAMA_CHAT_USER_HEADER", "")
+
+JOURNAL_COMPACT_MIN_RECORDS = 200
+JOURNAL_COMPACT_RATIO = 2  # compact once the journal has this many records per live message
+ARCHIVE_PAGE_SIZE = 10
+TRANSCRIPT_WINDOW = 30  # messages rendered per rerun; older ones load on demand
+HISTORY_STORE_SIZE = 64  # conversations kept parsed in memory across reruns and reloads
+
+STATIC_LOCATION = os.environ.get("OLLAMA_CHAT_LOCATION")  # "City, Country"; skips the IP lookup
+LOCATION_TTL = 6 * 60 * 60
+LOCATION_RETRY = 60  # seconds between attempts while the lookup keeps failing
+
+# comma-separated list; generations are spread across all of them
+OLLAMA_HOSTS = [
+    host.strip().rstrip("/")
+    for host in os.environ.get("OLLAMA_CHAT_OLLAMA_URL", "http://localhost:11434").split(",") if host.strip()
+]
+OLLAMA_MODEL = os.environ.get("OLLAMA_CHAT_MODEL", "gemma3:1b")
+OLLAMA_SMALL_MODEL = os.environ.get("OLLAMA_CHAT_SMALL_MODEL", "")  # optional, for short one-line prompts
+OLLAMA_SMALL_PROMPT_CHARS = 80
+OLLAMA_BACKEND_SLOTS = int(os.environ.get("OLLAMA_CHAT_BACKEND_SLOTS", "2"))  # match OLLAMA_NUM_PARALLEL
+OLLAMA_QUEUE_TIMEOUT = 120  # seconds a generation may wait for a free backend
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_OPTIONS = {"num_ctx": 8192}  # changing num_ctx between calls reloads the model
+
+HISTORY_TOKEN_BUDGET = 3000
+HISTORY_KEEP_RATIO = 0.5  # after summarizing, keep this share of the budget verbatim
+SUMMARY_INPUT_CHARS = 600  # per message, when folding old turns into the summary
+
+# Per-stage deadlines (seconds) for the work done before calling Ollama
+SEARCH_STAGE_TIMEOUT = 4
+TRANSLATE_STAGE_TIMEOUT = 4
+
+JOB_WORKERS = max(4, 2 * OLLAMA_BACKEND_SLOTS * len(OLLAMA_HOSTS))  # turns in progress across all sessions
+JOB_POLL_INTERVAL = 0.5  # seconds between UI refreshes while a turn is running
+JOB_RETENTION = 10 * 60  # finished jobs nobody collected are dropped after this
+
+METRICS_FILE = history_dir / "metrics" / "spans.jsonl"
+METRICS_MAX_BYTES = 5 * 1024 * 1024  # rotated into spans.jsonl.1 .. .3
+METRICS_BACKUPS = 3
+METRICS_WINDOW = 500  # recent spans per stage kept in memory for percentiles
+
+SEARCH_URL = os.environ.get("OLLAMA_CHAT_SEARCH_URL", "https://www.google.com/search")
+# engine -> (default url, class lists of the elements that hold one result each)
+SEARCH_ENGINES = {
+    "google": (SEARCH_URL, ("VwiC3b", "BNeawe s3v9rd AP7Wnd")),
+    "duckduckgo": ("https://html.duckduckgo.com/html/", ("result__snippet",)),
+}
+# queried in parallel; "engine" or "engine=url", e.g. google=http://localhost:8000/search
+SEARCH_SOURCES = [
+    (name.strip(), (url or SEARCH_ENGINES[name.strip()][0]).strip())
+    for name, _, url in (item.partition("=") for item in
+                         os.environ.get("OLLAMA_CHAT_SEARCH_SOURCES", "google,duckduckgo").split(","))
+    if name.strip() in SEARCH_ENGINES
+]
+SEARCH_RESULTS = 3  # snippets kept per turn, merged across sources
+SEARCH_DEADLINE = 3  # seconds; sources that haven't answered by then are left out
+SEARCH_MAX_BYTES = 1024 * 1024  # stop reading a page after this much
+SEARCH_WORKERS = 8
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 30 * 60  # seconds an answer counts as fresh
+SEARCH_CACHE_STALE_TTL = 6 * 60 * 60  # after that, serve it once more while refreshing
+SEARCH_CACHE_ON_DISK = True
+
+LOCAL_CONTEXT_K = 3  # past exchanges from the user's own chats added to the prompt
+LOCAL_SNIPPET_CHARS = 500
+LOCAL_SNIPPET_MIN_COVERAGE = 0.5  # share of the question's words an exchange must contain to be used
+LOCAL_STOP_WORDS = {
+    "a", "an", "the", "and", "or", "but", "of", "in", "on", "at", "to", "for", "from", "by", "with", "about",
+    "is", "are", "was", "were", "be", "been", "do", "does", "did", "can", "could", "would", "should", "will",
+    "what", "who", "whom", "which", "when", "where", "why", "how", "that", "this", "these", "those", "there",
+    "i", "me", "my", "you", "your", "we", "our", "it", "its", "he", "she", "they", "them", "his", "her",
+    "tell", "please", "pls", "hey", "hi", "any", "some", "much", "many", "more", "not", "has", "have", "had",
+}
+TIME_SENSITIVE_WORDS = {
+    "today", "tonight", "tomorrow", "yesterday", "now", "current", "currently", "latest", "recent",
+    "news", "weather", "forecast", "price", "prices", "score", "live", "week", "update",
+}
 
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "gemma3:1b"
+TRANSLATION_CACHE_SIZE = 2048
+TRANSLATION_CHUNK_CHARS = 4500  # GoogleTranslator rejects texts over 5000 characters
+
+TTS_CHUNK_CHARS = 220  # sentences are grouped up to this size before synthesis
+TTS_WORKERS = 2  # chunk N+1 is synthesized while chunk N plays
+TTS_CHUNK_TIMEOUT = 15
+TTS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TTS_PLAYBACK_MARGIN = 0.5  # extra wait after the estimated end of playback before listening again
+# Off by default: other programs' tmp*.mp3 files in the shared temp dir look the same
+SWEEP_ORPHANED_AUDIO = os.environ.get("OLLAMA_CHAT_SWEEP_TEMP_AUDIO", "") == "1"
+ORPHAN_AUDIO_MAX_AGE = 60 * 60  # leftover temp MP3s older than this are swept at startup
+
+VOICE_SAMPLE_RATE = 16000
+VOICE_FRAME_SAMPLES = 480  # 30 ms frames for endpointing
+VOICE_CALIBRATION_SECONDS = 0.5  # ambient noise is measured once per session
+VOICE_LISTEN_TIMEOUT = 10  # seconds to wait for speech to start
+VOICE_MAX_SECONDS = 30
+VAD_ENERGY_RATIO = 3.0  # a frame is speech when it's this much louder than the noise floor
+VAD_MIN_ENERGY = 300
+VAD_START_FRAMES = 3  # consecutive loud frames that start an utterance
+VAD_PREROLL = 0.3  # seconds kept from before the start, so the first syllable isn't cut off
+VAD_HANGOVER = 0.6  # seconds of silence that end the utterance
+STT_BACKEND = os.environ.get("OLLAMA_CHAT_STT", "google")
+STT_SEGMENT_PAUSE = 0.25  # a pause this long inside an utterance sends what came before it off early
+STT_SEGMENT_MIN_SECONDS = 2
+STT_WORKERS = 2
+STT_TIMEOUT = 15
+VOSK_MODEL_PATH = os.environ.get("OLLAMA_CHAT_VOSK_MODEL", "")
+OLLAMA_STREAM_TIMEOUT = (5, 120)  # (connect, read between chunks)
+OLLAMA_TIMEOUT = (5, 300)  # non-streaming calls wait for the whole answer
+OLLAMA_POOL_SIZE = OLLAMA_BACKEND_SLOTS + 1  # per backend: generations plus the warm-up
+OLLAMA_BREAKER_FAILURES = 3  # consecutive connection failures before failing fast
+OLLAMA_BREAKER_COOLDOWN = 15  # seconds before one trial request is let through
+
+HTTP_TIMEOUT = (3.05, 5)  # (connect, read) for search and news pages
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 4  # connections per host; further requests to it wait for one to free up
+HTTP_RETRIES = 2  # GET only; POSTs are never retried
+HTTP_BACKOFF = 0.3  # seconds, doubled per retry, plus up to this much jitter
 
 # === Streamlit Setup ===
 st.set_page_config(
@@ -188,25 +320,736 @@ default_session_state = {
     "browser_open": False,
     "processing_voice": False,
     "speech_failed_count": 0,
+    "stream_responses": True,
+    "history_token_budget": HISTORY_TOKEN_BUDGET,
+    "summarize_history": True,
+    "history_summary": "",
+    "summary_upto": 0,
+    "prompt_stats": {},
+    "archive_page": 0,
+    "transcript_window": TRANSCRIPT_WINDOW,
+    "rendered_markdown": {},
+    "archive_last_query": "",
+    "session_id": uuid.uuid4().hex,
+    "model_warmed": False,
+    "stt_backend": STT_BACKEND,
+    "voice_noise_floor": None,
+    "playback_utterance": None,
+    "playback_until": 0.0,
 }
 for key, value in default_session_state.items():
     if key not in st.session_state:
         st.session_state[key] = value
 
+def storage_key(value):
+    return re.sub(r"[^A-Za-z0-9_-]", "", value or "")[:64]
+
+def signed_in_user():
+    # Archived chats are only kept apart for people the server has actually
+    # authenticated: Streamlit's own login (st.login) or a trusted proxy header.
+    user = getattr(st, "user", None)
+    if user is not None and user.get("is_logged_in"):
+        return f"user:{user.get('email') or user.get('sub')}"
+    if USER_HEADER and st.context.headers.get(USER_HEADER):
+        return f"user:{st.context.headers[USER_HEADER].strip()}"
+    return None
+
+def login_available():
+    try:
+        return hasattr(st, "login") and "auth" in st.secrets
+    except FileNotFoundError:  # no secrets.toml
+        return False
+
+def conversation_key(user_id, history_id):
+    # A signed-in user's conversations live under their account, so a ?sid=
+    # link opened by another account starts an empty conversation of its own
+    # instead of showing and extending the owner's.
+    if user_id == local_user_id:
+        return history_id
+    return f"{hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:16]}/{history_id}"
+
+# Each tab gets its own conversation, named by ?sid= in the URL so a reload
+# finds it again. Archived chats belong to the signed-in user, or without
+# sign-in to the OS user running the server, as before.
+local_user_id = storage_key(username) or "local"
+if "history_id" not in st.session_state:
+    st.session_state.user_id = signed_in_user() or local_user_id
+    st.session_state.history_id = storage_key(st.query_params.get("sid")) or uuid.uuid4().hex
+    st.session_state.conversation_id = conversation_key(st.session_state.user_id, st.session_state.history_id)
+if st.query_params.get("sid") != st.session_state.history_id:
+    st.query_params["sid"] = st.session_state.history_id
+
 # === History Load ===
-if not history_file.exists():
-    with open(history_file, "w", encoding="utf-8") as f:
-        json.dump([], f)
+# Every conversation is a journal in sessions/<sid>.jsonl (in a folder per
+# account for signed-in users): one JSON record per line, appended (and
+# fsynced) as messages arrive. Full rewrites only happen on compaction and
+# always go through a temp file + rename, so a crash never leaves a
+# half-written history behind. Writers hold an OS file lock, and parsed
+# journals are kept per process, so reruns, reloads and tabs sharing a sid
+# don't re-read the file unless another process wrote it.
+@contextmanager
+def file_lock(path):
+    with open(path.with_suffix(".lock"), "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def journal_size(path):
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def write_journal(store, messages):
+    tmp_path = store["path"].with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for msg in messages:
+            f.write(json.dumps({"op": "append", "message": msg}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, store["path"])
+    store["records"] = len(messages)
+    store["size"] = journal_size(store["path"])
+
+def append_journal(store, record):
+    with open(store["path"], "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    store["records"] += 1
+    store["size"] = journal_size(store["path"])
+    if store["records"] > max(JOURNAL_COMPACT_MIN_RECORDS, JOURNAL_COMPACT_RATIO * len(store["messages"])):
+        write_journal(store, store["messages"])
+
+def load_journal(path):
+    messages, records, damaged = [], 0, False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                damaged = True  # torn write from a crash; drop it
+                continue
+            records += 1
+            if record.get("op") == "append":
+                messages.append(record["message"])
+            elif record.get("op") == "clear":
+                messages = []
+    return messages, records, damaged
+
+def sync_store(store):
+    # Called with the store's locks held. The message list is updated in
+    # place: every session on this sid holds a reference to it.
+    size = journal_size(store["path"])
+    if size == store["size"]:
+        return
+    messages, records, damaged = load_journal(store["path"]) if size else ([], 0, False)
+    store["messages"][:] = messages
+    store["records"], store["size"] = records, size
+    if damaged:
+        write_journal(store, store["messages"])
+
+@st.cache_resource(show_spinner=False)
+def get_history_stores():
+    return {"lock": threading.Lock(), "stores": OrderedDict()}
+
+def get_history_store():
+    # The registry lets tabs and reloads share a parsed journal; each session
+    # also keeps its own store, so evicting idle conversations from the
+    # registry never makes an open one re-read its file.
+    conversation_id = st.session_state.conversation_id
+    registry = get_history_stores()
+    with registry["lock"]:
+        store = registry["stores"].get(conversation_id)
+        if store is None:
+            store = st.session_state.get("history_store")
+            if store is None or store["conversation_id"] != conversation_id:
+                path = sessions_dir / f"{conversation_id}.jsonl"
+                path.parent.mkdir(exist_ok=True)
+                store = {"conversation_id": conversation_id, "path": path, "messages": [], "records": 0, "size": 0,
+                         "lock": threading.Lock()}
+            registry["stores"][conversation_id] = store
+        registry["stores"].move_to_end(conversation_id)
+        while len(registry["stores"]) > HISTORY_STORE_SIZE:
+            registry["stores"].popitem(last=False)
+    st.session_state.history_store = store
+    return store
+
+@contextmanager
+def locked_store():
+    store = get_history_store()
+    with store["lock"], file_lock(store["path"]):
+        sync_store(store)
+        yield store
+
+def append_message(msg):
+    with locked_store() as store:
+        store["messages"].append(msg)
+        append_journal(store, {"op": "append", "message": msg})
+
+def clear_history():
+    with locked_store() as store:
+        store["messages"].clear()
+        append_journal(store, {"op": "clear"})
+
+def replace_history(messages):
+    with locked_store() as store:
+        store["messages"][:] = messages
+        write_journal(store, store["messages"])
+
+history_store = get_history_store()
+if journal_size(history_store["path"]) != history_store["size"]:
+    with history_store["lock"], file_lock(history_store["path"]):
+        sync_store(history_store)
+st.session_state.messages = history_store["messages"]
+
+# === HTTP Client ===
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive connection failures; calls then fail
+    # at once for `cooldown` seconds, after which a single trial call decides
+    # whether it closes again or stays open for another cooldown.
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.time()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(f"{self.name} is unreachable, retrying in {max(1, math.ceil(remaining))}s")
+            self.trial = True
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and (self.trial or time.time() < self.opened_at + self.cooldown)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.time()
+
+    def end_call(self):
+        # Runs after every call whatever it raised, so a trial call that fails
+        # in some unexpected way can't leave the breaker waiting on it forever.
+        with self.lock:
+            self.trial = False
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    # One keep-alive pool per process, shared by every session and worker
+    # thread, so repeat calls to the same host skip the TCP/TLS handshake.
+    # Pools block when full, which makes their size a real per-host limit;
+    # every request has a read timeout, so a waiting one gets a connection.
+    session = requests.Session()
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    retry = Retry(
+        total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, backoff_jitter=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=False, raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, pool_block=True, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Ollama backends get their own pools and no retries: the circuit breaker decides
+    for backend in OLLAMA_HOSTS:
+        session.mount(
+            f"{backend}/",
+            HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE, pool_block=True, max_retries=0),
+        )
+    return session
 
-try:
-    with open(history_file, "r", encoding="utf-8") as f:
-        st.session_state.messages = json.load(f)
-except json.JSONDecodeError:
-    st.session_state.messages = []
+@st.cache_resource(show_spinner=False)
+def get_ollama_breaker(backend):
+    name = "Ollama" if len(OLLAMA_HOSTS) == 1 else f"Ollama at {backend}"
+    return CircuitBreaker(name, OLLAMA_BREAKER_FAILURES, OLLAMA_BREAKER_COOLDOWN)
 
-def save_history():
-    with open(history_file, "w", encoding="utf-8") as f:
-        json.dump(st.session_state.messages, f, ensure_ascii=False, indent=2)
+def ollama_post(backend, payload, stream=False, timeout=OLLAMA_TIMEOUT):
+    breaker = get_ollama_breaker(backend)
+    breaker.before_call()
+    try:
+        response = get_http_session().post(f"{backend}/api/chat", json=payload, stream=stream, timeout=timeout)
+    except (requests.ConnectionError, requests.Timeout):
+        breaker.record_failure()
+        raise
+    else:
+        breaker.record_success()
+    finally:
+        breaker.end_call()
+    return response
+
+# === Ollama Scheduler ===
+class OllamaScheduler:
+    # Generations wait here for a backend slot. Waiting requests are queued
+    # per session and served round-robin, so one busy session can't starve
+    # the others, and no backend runs more than `slots` generations at once.
+    # A session goes back to the backend it used last while that one has a
+    # free slot (its prompt prefix is still cached there), otherwise to the
+    # least busy healthy backend.
+    def __init__(self, backends, slots):
+        self.slots = slots
+        self.in_flight = {backend: 0 for backend in backends}
+        self.queues = OrderedDict()  # session -> deque of waiting tickets
+        self.affinity = OrderedDict()  # session -> backend it used last
+        self.cond = threading.Condition()
+
+    def pick_backend(self, preferred):
+        healthy = [backend for backend in self.in_flight if not get_ollama_breaker(backend).is_open()]
+        free = [backend for backend in healthy or self.in_flight if self.in_flight[backend] < self.slots]
+        if preferred in free:
+            return preferred
+        return min(free, key=self.in_flight.get) if free else None
+
+    def dispatch(self):
+        # caller holds self.cond
+        while self.queues:
+            session, queue = next(iter(self.queues.items()))
+            backend = self.pick_backend(self.affinity.get(session))
+            if backend is None:
+                break
+            ticket = queue.popleft()
+            del self.queues[session]
+            if queue:
+                self.queues[session] = queue  # back of the round
+            ticket["backend"] = backend
+            self.in_flight[backend] += 1
+            self.affinity[session] = backend
+            self.affinity.move_to_end(session)
+            while len(self.affinity) > 1024:
+                self.affinity.popitem(last=False)
+            self.cond.notify_all()
+
+    def acquire(self, session, cancel_event=None, timeout=OLLAMA_QUEUE_TIMEOUT):
+        ticket = {"backend": None}
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.queues.setdefault(session, deque()).append(ticket)
+            self.dispatch()
+            while ticket["backend"] is None:
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                if cancelled or time.monotonic() > deadline:
+                    queue = self.queues.get(session)
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.queues[session]
+                    raise RuntimeError("Cancelled." if cancelled else "All Ollama backends are busy, try again shortly.")
+                self.cond.wait(0.25)
+        return ticket["backend"]
+
+    def release(self, backend):
+        with self.cond:
+            self.in_flight[backend] -= 1
+            self.dispatch()
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.in_flight), sum(len(queue) for queue in self.queues.values())
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_scheduler():
+    return OllamaScheduler(OLLAMA_HOSTS, OLLAMA_BACKEND_SLOTS)
+
+@contextmanager
+def ollama_slot(session, stats=None, cancel_event=None):
+    scheduler = get_ollama_scheduler()
+    started = time.perf_counter()
+    backend = scheduler.acquire(session or "", cancel_event)
+    if stats is not None:
+        stats["backend"] = backend
+        stats["queue_duration"] = int((time.perf_counter() - started) * 1e9)
+    try:
+        yield backend
+    finally:
+        scheduler.release(backend)
+
+def pick_model(text):
+    # short one-line prompts ("thanks!", "what time is it?") don't need the big model
+    if OLLAMA_SMALL_MODEL and len(text) <= OLLAMA_SMALL_PROMPT_CHARS and "\n" not in text.strip():
+        return OLLAMA_SMALL_MODEL
+    return OLLAMA_MODEL
+
+# === Caches ===
+class TTLCache:
+    # Thread-safe LRU whose entries expire after `ttl` seconds. Expired entries
+    # are still returned (flagged stale) for another `stale_ttl` seconds so the
+    # caller can refresh them in the background. With `disk_dir`, every entry
+    # is also kept as one small JSON file so the cache survives restarts.
+    def __init__(self, max_entries, ttl=None, stale_ttl=0, disk_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0}
+        if disk_dir:
+            disk_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk()
+
+    def _path(self, key):
+        return self.disk_dir / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json"
+
+    def _load_disk(self):
+        for leftover in self.disk_dir.glob("*.tmp"):
+            leftover.unlink(missing_ok=True)
+        loaded = []
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                loaded.append((entry["stored_at"], entry["key"], entry["value"]))
+            except (OSError, ValueError, KeyError):
+                path.unlink(missing_ok=True)
+        for stored_at, key, value in sorted(loaded):
+            self.entries[key] = (stored_at, value)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            key, _ = self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+            if self.disk_dir:
+                self._path(key).unlink(missing_ok=True)
+
+    def get(self, key):
+        # Returns (value, fresh) or None.
+        with self.lock:
+            entry = self.entries.get(key)
+            age = time.time() - entry[0] if entry else None
+            if entry is None or (self.ttl is not None and age > self.ttl + self.stale_ttl):
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            fresh = self.ttl is None or age <= self.ttl
+            self.stats["hits" if fresh else "stale_hits"] += 1
+            return entry[1], fresh
+
+    def put(self, key, value):
+        stored_at = time.time()
+        with self.lock:
+            self.entries[key] = (stored_at, value)
+            self.entries.move_to_end(key)
+            self.refreshing.discard(key)
+            self._evict()
+        if self.disk_dir:
+            # a temp file per write, so two threads storing the same key don't
+            # rename each other's file away; the disk copy is best effort
+            path = self._path(key)
+            tmp_path = path.with_name(f"{path.stem}.{uuid.uuid4().hex[:8]}.tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"key": key, "stored_at": stored_at, "value": value}, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except OSError:
+                tmp_path.unlink(missing_ok=True)
+
+    def claim_refresh(self, key):
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def __len__(self):
+        return len(self.entries)
+
+@st.cache_resource(show_spinner=False)
+def get_search_cache():
+    disk_dir = history_dir / "search_cache" if SEARCH_CACHE_ON_DISK else None
+    return TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, disk_dir)
+
+@st.cache_resource(show_spinner=False)
+def get_translation_cache():
+    return TTLCache(TRANSLATION_CACHE_SIZE)
+
+class AudioCache:
+    # Synthesized speech stored as <sha256(lang, text)>.mp3. Hits refresh the
+    # file's mtime, and the least recently used files go first once the
+    # directory grows past max_bytes.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        directory.mkdir(parents=True, exist_ok=True)
+        for leftover in directory.glob("*.tmp"):
+            leftover.unlink(missing_ok=True)
+        self.total_bytes = sum(path.stat().st_size for path in directory.glob("*.mp3"))
+
+    def _path(self, lang, text):
+        digest = hashlib.sha256(f"{lang}\n{text}".encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}.mp3"
+
+    def get(self, lang, text):
+        path = self._path(lang, text)
+        try:
+            audio = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return audio
+
+    def put(self, lang, text, audio):
+        path = self._path(lang, text)
+        tmp_path = path.with_name(f"{path.stem}.{uuid.uuid4().hex[:8]}.tmp")
+        tmp_path.write_bytes(audio)
+        with self.lock:
+            previous = path.stat().st_size if path.exists() else 0
+            os.replace(tmp_path, path)
+            self.total_bytes += len(audio) - previous
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self.directory.glob("*.mp3"), key=lambda path: path.stat().st_mtime)
+        for path in files:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+
+def sweep_orphaned_audio():
+    # Older versions saved every answer to a NamedTemporaryFile(delete=False)
+    # in the system temp dir and never removed it. Nothing marks those files
+    # as ours, so this only runs when asked to.
+    cutoff = time.time() - ORPHAN_AUDIO_MAX_AGE
+    for path in Path(tempfile.gettempdir()).glob("tmp*.mp3"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def get_audio_cache():
+    if SWEEP_ORPHANED_AUDIO:
+        sweep_orphaned_audio()
+    return AudioCache(history_dir / "tts_cache", TTS_CACHE_MAX_BYTES)
+
+get_audio_cache()
+
+# === Tracing ===
+# Every pipeline stage of a turn is recorded as a span: one JSON line in a
+# rotating file for offline analysis, plus a per-stage window in memory for
+# the Diagnostics panel.
+@st.cache_resource(show_spinner=False)
+def get_tracer():
+    METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    logger = logging.getLogger("ollama_chat.spans")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = RotatingFileHandler(
+            METRICS_FILE, maxBytes=METRICS_MAX_BYTES, backupCount=METRICS_BACKUPS, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    return {"logger": logger, "recent": {}, "lock": threading.Lock()}
+
+def record_span(turn_id, stage, duration, **fields):
+    tracer = get_tracer()
+    span = {"ts": round(time.time(), 3), "turn": turn_id, "stage": stage,
+            "duration_ms": round(duration * 1000, 1), **fields}
+    with tracer["lock"]:
+        tracer["recent"].setdefault(stage, deque(maxlen=METRICS_WINDOW)).append(span["duration_ms"])
+    tracer["logger"].info(json.dumps(span, ensure_ascii=False))
+
+@contextmanager
+def trace_span(turn_id, stage, **fields):
+    # Yields a dict; anything put into it is stored with the span.
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record_span(turn_id, stage, time.perf_counter() - started, **fields)
+
+def record_ollama_spans(turn_id, stats):
+    # Ollama reports durations in nanoseconds; prefill and decode are split
+    # out as their own stages so they get their own percentiles.
+    if "queue_duration" in stats:
+        record_span(turn_id, "ollama_queue", stats["queue_duration"] / 1e9, backend=stats.get("backend"))
+    for stage, key in (("ollama_load", "load_duration"), ("ollama_prefill", "prompt_eval_duration"),
+                       ("ollama_eval", "eval_duration")):
+        if stats.get(key):
+            record_span(turn_id, stage, stats[key] / 1e9,
+                        tokens=stats.get("eval_count" if key == "eval_duration" else "prompt_eval_count"))
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def stage_percentiles():
+    tracer = get_tracer()
+    with tracer["lock"]:
+        recent = {stage: list(values) for stage, values in tracer["recent"].items()}
+    return [
+        (stage, len(values), percentile(values, 0.5), percentile(values, 0.95))
+        for stage, values in sorted(recent.items()) if values
+    ]
+
+# === Location Context ===
+@st.cache_resource(show_spinner=False)
+def get_location_state():
+    return {"city": None, "country": None, "resolved_at": 0.0, "attempted_at": 0.0,
+            "refreshing": False, "lock": threading.Lock()}
+
+def resolve_location(state):
+    try:
+        import geocoder
+        location = geocoder.ip('me')
+        if getattr(location, "ok", False):
+            state["city"], state["country"] = location.city, location.country
+            state["resolved_at"] = time.time()
+    except Exception:
+        pass
+    finally:
+        state["refreshing"] = False
+
+def get_location():
+    # Never waits on the network: returns the last known (city, country),
+    # (None, None) until the first lookup lands, and refreshes in the
+    # background once the value is older than LOCATION_TTL.
+    if STATIC_LOCATION:
+        city, _, country = STATIC_LOCATION.rpartition(",")
+        return city.strip() or None, country.strip() or None
+    state = get_location_state()
+    now = time.time()
+    with state["lock"]:
+        if (now - state["resolved_at"] > LOCATION_TTL and now - state["attempted_at"] > LOCATION_RETRY
+                and not state["refreshing"]):
+            state["refreshing"] = True
+            state["attempted_at"] = now
+            threading.Thread(target=resolve_location, args=(state,), daemon=True).start()
+    return state["city"], state["country"]
+
+get_location()
+
+# === Translation ===
+SCRIPT_LANGUAGES = [
+    ("ja", re.compile(r"[\u3040-\u30ff]")),
+    ("zh-CN", re.compile(r"[\u4e00-\u9fff]")),
+    ("ar", re.compile(r"[\u0600-\u06ff]")),
+    ("iw", re.compile(r"[\u0590-\u05ff]")),
+    ("el", re.compile(r"[\u0370-\u03ff]")),
+    ("ru", re.compile(r"[\u0400-\u04ff]")),
+]
+# Only words that aren't also everyday words in other Latin-script languages:
+# "was", "in", "me", "is", "of", "will", "an" and the like would make German,
+# Spanish, Italian or Dutch look English.
+ENGLISH_HINT_WORDS = {
+    "the", "and", "are", "were", "been", "this", "that", "these", "those", "with", "you", "your",
+    "what", "how", "why", "who", "when", "where", "which", "does", "would", "should", "could",
+    "there", "they", "their", "about", "have", "has", "not", "please", "tell", "know", "want",
+}
+ENGLISH_MIN_WORDS = 3
+
+def detect_language(text):
+    # Local best guess: non-Latin scripts by Unicode block, English by common
+    # function words. Returns None when unsure and the translator has to decide.
+    letters = re.findall(r"[^\W\d_]", text)
+    if not letters:
+        return None
+    for lang, pattern in SCRIPT_LANGUAGES:
+        if len(pattern.findall(text)) * 2 >= len(letters):
+            return lang
+    words = re.findall(r"[a-z']+", text.lower())
+    if len(words) >= ENGLISH_MIN_WORDS and sum(w in ENGLISH_HINT_WORDS for w in words) * 3 >= len(words):
+        if all(ord(c) < 128 for c in letters):
+            return "en"
+    return None
+
+def translate_text(text, target, source="auto"):
+    if not re.search(r"[^\W\d_]", text):
+        return text
+    if (source if source != "auto" else detect_language(text)) == target:
+        return text
+    cache = get_translation_cache()
+    key = f"{source}:{target}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0]
+    from deep_translator import GoogleTranslator
+    translated = GoogleTranslator(source=source, target=target).translate(text) or text
+    cache.put(key, translated)
+    return translated
+
+@st.cache_resource(show_spinner=False)
+def get_translation_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="translate")
+
+# a fenced block runs to its closing fence (or the end of an unfinished answer)
+CODE_FENCE = re.compile(r"(^[ \t]*```.*?(?:^[ \t]*```[^\n]*$|\Z))", re.M | re.S)
+
+def translate_long_text(text, target, source="auto"):
+    # Paragraphs are translated (and cached) one by one, in parallel; fenced
+    # code blocks are kept whole, blank lines inside them included. Paragraphs
+    # above the API limit are split further.
+    if (source if source != "auto" else detect_language(text)) == target:
+        return text
+    if "```" not in text and "\n\n" not in text and len(text) <= TRANSLATION_CHUNK_CHARS:
+        return translate_text(text, target, source)
+
+    # odd entries are code blocks and paragraph breaks, copied as they are
+    parts = []
+    for i, segment in enumerate(CODE_FENCE.split(text)):
+        if i % 2:
+            parts.append(segment)
+        else:
+            parts.extend(re.split(r"(\n[ \t]*\n)", segment))
+
+    def translate_paragraph(paragraph):
+        pieces = [
+            paragraph[i:i + TRANSLATION_CHUNK_CHARS]
+            for i in range(0, len(paragraph), TRANSLATION_CHUNK_CHARS)
+        ] or [paragraph]
+        return "".join(translate_text(piece, target, source) for piece in pieces)
+
+    parts[::2] = get_translation_executor().map(translate_paragraph, parts[::2])
+    return "".join(parts)
+
+def translate_canned(text, lang):
+    # Fixed UI phrases are translated once and then always come from the cache.
+    try:
+        return translate_text(text, lang, source="en")
+    except Exception:
+        return text
 
 # === Helper Functions ===
 def clean_text_for_tts(text):
@@ -222,123 +1065,494 @@ def clean_text_for_tts(text):
     )
     return re.sub(r'\s+', ' ', emoji_pattern.sub('', text)).strip()
 
-def build_conversation_prompt():
-    now = datetime.now().strftime('%A, %d %B %Y %I:%M %p')
-    location = geocoder.ip('me')
-    loc_str = f"{location.country}" if getattr(location, "ok", False) else "Unknown Location"
+def build_system_prompt():
+    # Only changes once a day, so Ollama can keep reusing the cached prefix.
+    today = datetime.now().strftime('%A, %d %B %Y')
+    _, country = get_location()
+    loc_str = country or "Unknown Location"
 
-    system_prompt = (
-        f"You are a smart, self-aware assistant named Gemma. You know the current date and time is {now} and you are located in {loc_str}.\n"
+    return (
+        f"You are a smart, self-aware assistant named Gemma. You know today's date is {today} and you are located in {loc_str}.\n"
         "You use real web data, add hyperlinks in a markdown format when possible, and always aim to provide fresh and concise information. Do not prefix responses with 'Assistant'."
     )
-    history = ""
-    for msg in st.session_state.messages:
-        role = "user" if msg["role"] == "user" else "assistant"
-        content_clean = re.sub(r"^(User|Assistant):\\s*", "", msg["content"])
-        history += f"{role}: {content_clean}\n"
-    return f"{system_prompt}\n\n{history}user:"
 
-def perform_web_search(query):
-    try:
-        url = f"https://www.google.com/search?q={quote(query)}"
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-        snippets = [
-            result.get_text(strip=True)
-            for result in soup.select("div.VwiC3b, div.BNeawe.s3v9rd.AP7Wnd")
-        ][:3]
-        if snippets:
-            return "Web search results:\n" + "\n".join(f"- {s}" for s in snippets)
-        return "Web search found no results."
-    except Exception as e:
-        return f"Web search failed: {e}"
-
-def generate_ollama_response(prompt_text, search_results=None):
+def build_user_turn(prompt_text, search_results=None, local_context=None):
+    sources = []
+    if local_context:
+        sources.append("Using these excerpts from earlier conversations with the user:\n" + "\n\n".join(local_context))
     if search_results:
+        sources.append(f"Using the following information from a web search:\n{search_results}")
+    if sources:
         prompt_text = (
-            f"Using the following information from a web search:\n{search_results}\n\n"
+            "\n\n".join(sources) + "\n\n"
             f"Based on this, answer the following question: {prompt_text}. "
             f"Format any links in markdown like this: [text](url)."
         )
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": f"{build_conversation_prompt()} {prompt_text}\n",
-        "stream": False,
-    }
+    return f"(Current time: {datetime.now().strftime('%I:%M %p')})\n{prompt_text}"
+
+def llm_text(msg):
+    return msg.get("llm_content") or re.sub(r"^(User|Assistant):\s*", "", msg["content"])
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token, but never fewer than one per word/symbol.
+    return max(len(text) // 4, len(re.findall(r"\w+|[^\w\s]", text))) + 4
+
+def reset_history_summary():
+    st.session_state.history_summary = ""
+    st.session_state.summary_upto = 0
+
+def summarize_history(summary, messages, session=None):
+    transcript = "\n".join(
+        f"{'user' if msg['role'] == 'user' else 'assistant'}: {llm_text(msg)[:SUMMARY_INPUT_CHARS]}"
+        for msg in messages
+    )
+    prompt = (
+        "Update the running summary of a conversation between a user and an assistant.\n"
+        f"Current summary:\n{summary or '(empty)'}\n\n"
+        f"New messages:\n{transcript}\n\n"
+        "Reply with only the updated summary, under 150 words, keeping names, facts and open questions."
+    )
     try:
-        response = requests.post(OLLAMA_API_URL, headers=headers, data=json.dumps(payload))
+        result = generate_ollama_response([{"role": "user", "content": prompt}], session=session)
+    except Exception:
+        return None
+    return clean_ai_response(result or "") or None
+
+def update_history_window(state, on_summarize=None):
+    # The window start only moves when the verbatim part overflows the budget,
+    # and then jumps far enough that the next several turns keep the same
+    # prefix (and Ollama's prompt cache) instead of sliding every turn.
+    messages = state["messages"]
+    budget = state["history_token_budget"]
+    upto = min(state["summary_upto"], len(messages))
+    costs = [estimate_tokens(llm_text(msg)) for msg in messages[upto:]]
+    total = sum(costs)
+    if total <= budget:
+        state["summary_upto"] = upto
+        return
+
+    new_upto = upto
+    for cost in costs[:-1]:
+        if total <= budget * HISTORY_KEEP_RATIO and messages[new_upto]["role"] == "user":
+            break
+        total -= cost
+        new_upto += 1
+
+    if state["summarize_history"]:
+        if on_summarize:
+            on_summarize()
+        summary = summarize_history(state["history_summary"], messages[upto:new_upto], session=state.get("session_id"))
+        if summary is None:
+            # keep those messages verbatim and try again next turn rather
+            # than drop them from both the summary and the window
+            state["summary_upto"] = upto
+            return
+        state["history_summary"] = summary
+    state["summary_upto"] = new_upto
+
+def build_chat_messages(state):
+    # Past turns are re-sent exactly as the model first saw them ("llm_content"),
+    # so the prompt only grows at the end and Ollama reprocesses just the new turn.
+    messages = [{"role": "system", "content": build_system_prompt()}]
+    if state["summarize_history"] and state["history_summary"]:
+        messages.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{state['history_summary']}",
+        })
+    for msg in state["messages"][state["summary_upto"]:]:
+        role = "user" if msg["role"] == "user" else "assistant"
+        messages.append({"role": role, "content": llm_text(msg)})
+    state["prompt_stats"] = {
+        "estimated_tokens": sum(estimate_tokens(msg["content"]) for msg in messages),
+        "messages_sent": len(messages),
+    }
+    return messages
+
+def normalize_query(query):
+    # Only case, spacing and closing punctuation are folded: symbols and short
+    # words change meaning ("C++ tutorial", "The Who").
+    query = " ".join(query.casefold().split())
+    return query.rstrip("?!.。？！؟ ") or query
+
+class ResultParser(HTMLParser):
+    # Streams through a results page keeping only the text (and first link)
+    # of elements with one of the given class lists; no tree is built, and
+    # `done` is set once `limit` results are in so the download can stop.
+    # A result ends at the matching element's own end tag: end tags of other
+    # elements are ignored, since pages leave out </p>, </li> and the like.
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "wbr"}
+    OPTIONAL_END_TAGS = {"p", "li", "dt", "dd", "td", "th", "tr", "option"}
+
+    def __init__(self, class_lists, limit):
+        super().__init__(convert_charrefs=True)
+        self.class_lists = [set(classes.split()) for classes in class_lists]
+        self.limit = limit
+        self.results = []
+        self.tag, self.depth = None, 0  # the matched element, and how often it's open inside itself
+        self.text, self.href = [], None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == self.tag and tag in self.OPTIONAL_END_TAGS:
+            self.end_result()  # <li>...<li>: the first one ended without </li>
+        if self.tag:
+            if tag == self.tag:
+                self.depth += 1
+            if tag == "a" and self.href is None:
+                self.href = attrs.get("href")
+            return
+        classes = set((attrs.get("class") or "").split())
+        if not self.done and tag not in self.VOID_TAGS and any(wanted <= classes for wanted in self.class_lists):
+            self.tag, self.depth = tag, 1
+            self.text, self.href = [], attrs.get("href") if tag == "a" else None
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        if tag != self.tag:
+            return
+        self.depth -= 1
+        if not self.depth:
+            self.end_result()
+
+    def end_result(self):
+        text = " ".join("".join(self.text).split())
+        if text:
+            self.results.append((text, self.href))
+        self.tag, self.depth = None, 0
+        self.done = len(self.results) >= self.limit
+
+    def handle_data(self, data):
+        if self.tag:
+            self.text.append(data)
+
+@st.cache_resource(show_spinner=False)
+def get_search_executor():
+    return ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+def search_url(url, query, params=""):
+    return f"{url}{'&' if '?' in url else '?'}q={quote(query)}{params}"
+
+def fetch_results(url, class_lists, limit, deadline):
+    parser = ResultParser(class_lists, limit)
+    read_timeout = max(0.1, deadline - time.monotonic())
+    with get_http_session().get(url, stream=True, timeout=(HTTP_TIMEOUT[0], read_timeout)) as response:
         response.raise_for_status()
-        result = response.json()
-        return result.get("response", "No response from Ollama.")
+        response.encoding = response.encoding or "utf-8"
+        received = 0
+        for chunk in response.iter_content(chunk_size=16 * 1024, decode_unicode=True):
+            parser.feed(chunk)
+            received += len(chunk)
+            if parser.done or received > SEARCH_MAX_BYTES or time.monotonic() > deadline:
+                break
+    return parser.results[:limit]
+
+def fetch_web_search(query):
+    # All sources are asked at once; whatever has come back by the deadline
+    # is merged round-robin in source order, duplicates dropped.
+    deadline = time.monotonic() + SEARCH_DEADLINE
+    executor = get_search_executor()
+    futures = [
+        executor.submit(fetch_results, search_url(url, query), SEARCH_ENGINES[name][1], SEARCH_RESULTS, deadline)
+        for name, url in SEARCH_SOURCES
+    ]
+    wait(futures, timeout=SEARCH_DEADLINE)
+    per_source, errors = [], []
+    for future in futures:
+        if not future.done():
+            errors.append(TimeoutError("search timed out"))
+        elif future.exception():
+            errors.append(future.exception())
+        else:
+            per_source.append([text for text, _ in future.result()])
+    snippets, seen = [], set()
+    for rank in range(SEARCH_RESULTS):
+        for results in per_source:
+            if rank < len(results) and results[rank].casefold() not in seen:
+                seen.add(results[rank].casefold())
+                snippets.append(results[rank])
+    if snippets:
+        return "Web search results:\n" + "\n".join(f"- {s}" for s in snippets[:SEARCH_RESULTS])
+    if errors and not per_source:
+        raise errors[0]
+    return "Web search found no results."
+
+def refresh_web_search(query, key):
+    try:
+        get_search_cache().put(key, fetch_web_search(query))
+    except Exception:
+        get_search_cache().refreshing.discard(key)
+
+def perform_web_search(query):
+    cache = get_search_cache()
+    key = normalize_query(query)
+    cached = cache.get(key)
+    if cached is not None:
+        value, fresh = cached
+        if not fresh and cache.claim_refresh(key):
+            get_stage_executor().submit(refresh_web_search, query, key)
+        return value
+    try:
+        result = fetch_web_search(query)
     except Exception as e:
-        return f"❌ Error: {e}"
+        return f"Web search failed: {e}"
+    cache.put(key, result)
+    return result
+
+def build_ollama_payload(messages, stream=False, model=OLLAMA_MODEL):
+    return {
+        "model": model,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": OLLAMA_OPTIONS,
+    }
 
-def get_local_news_summary():
+def ollama_stats(chunk):
+    return {key: value for key, value in chunk.items() if key.endswith(("_count", "_duration"))}
+
+def generate_ollama_response(messages, stats=None, session=None, model=OLLAMA_MODEL):
+    # Raises when the request fails and returns None for an empty reply;
+    # callers decide what the user sees.
+    payload = build_ollama_payload(messages, model=model)
+    with ollama_slot(session, stats) as backend:
+        response = ollama_post(backend, payload)
+        response.raise_for_status()
+        result = response.json()
+    if stats is not None:
+        stats.update(ollama_stats(result))
+    return result.get("message", {}).get("content") or None
+
+def stream_ollama_response(messages, stats=None, session=None, model=OLLAMA_MODEL, cancel_event=None):
+    # Ollama sends one JSON object per line; closing this generator closes the
+    # connection, which makes Ollama abort the generation, and frees the slot.
+    payload = build_ollama_payload(messages, stream=True, model=model)
+    with ollama_slot(session, stats, cancel_event) as backend, \
+            ollama_post(backend, payload, stream=True, timeout=OLLAMA_STREAM_TIMEOUT) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(chunk["error"])
+            content = chunk.get("message", {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                if stats is not None:
+                    stats.update(ollama_stats(chunk))
+                return
+
+@st.cache_resource(show_spinner=False)
+def get_warmup_state():
+    return {"running": False, "lock": threading.Lock()}
+
+def load_model(state):
+    # An empty chat request makes Ollama load the model and keep it resident
+    # for OLLAMA_KEEP_ALIVE; same options as real turns so it isn't reloaded.
+    # Every backend gets it, since any of them may serve the first turn.
     try:
-        location = geocoder.ip('me')
-        city = getattr(location, "city", None) or "your city"
-        country = getattr(location, "country", None) or "your country"
+        for backend in OLLAMA_HOSTS:
+            for model in filter(None, (OLLAMA_MODEL, OLLAMA_SMALL_MODEL)):
+                started = time.perf_counter()
+                try:
+                    response = ollama_post(backend, build_ollama_payload([], model=model))
+                    response.raise_for_status()
+                    record_span(None, "warmup", time.perf_counter() - started, model=model, backend=backend)
+                except Exception:
+                    break
+    finally:
+        state["running"] = False
+
+def warm_up_model():
+    # Once per session, in the background, so the first answer doesn't pay
+    # the model load time.
+    if st.session_state.model_warmed:
+        return
+    st.session_state.model_warmed = True
+    state = get_warmup_state()
+    with state["lock"]:
+        if state["running"]:
+            return
+        state["running"] = True
+    threading.Thread(target=load_model, args=(state,), daemon=True).start()
+
+def get_local_news_summary(lang="en"):
+    try:
+        city, country = get_location()
+        city = city or "your city"
+        country = country or "your country"
         location_str = f"{city}, {country}"
 
         query = f"{city} news site:news.google.com"
-        url = f"https://www.google.com/search?q={quote(query)}&tbm=nws"
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        articles = []
-        for item in soup.select("div.dbsr")[:3]:
-            a = item.select_one("a")
-            title = item.get_text(strip=True)
-            link = a['href'] if a else None
-            if title and link:
-                articles.append(f"- [{title}]({link})")
+        url = search_url(SEARCH_URL, query, "&tbm=nws")
+        results = fetch_results(url, ("dbsr",), 3, time.monotonic() + SEARCH_DEADLINE)
+        articles = [f"- [{title}]({link})" for title, link in results if link]
 
         if not articles:
-            return f"Couldn't find news for {location_str}."
-        return f"Here’s what I learned from today’s local news in {location_str}:\n\n" + "\n".join(articles)
+            return translate_canned(f"Couldn't find news for {location_str}.", lang)
+        preamble = translate_canned(f"Here’s what I learned from today’s local news in {location_str}:", lang)
+        return f"{preamble}\n\n" + "\n".join(articles)
     except Exception as e:
         return f"News fetch error: {e}"
 
-def text_to_speech(text, lang='en'):
-    try:
-        lines = text.split("\n")
-        clean_lines = [line for line in lines if "[" not in line and "http" not in line]
-        clean_text = clean_text_for_tts(" ".join(clean_lines))
-        tts = gTTS(text=clean_text, lang=lang)
-        temp_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3").name
-        tts.save(temp_path)
+# Runs once in the page itself (not in the component iframe), so queued audio
+# keeps playing after Streamlit reruns and removes the iframe that sent it.
+TTS_PLAYER_JS = """
+window.__ttsPlayer = window.__ttsPlayer || (function() {
+  const player = {queue: [], seen: new Set(), utterance: null, audio: null};
+  function playNext() {
+    const chunk = player.queue.shift();
+    if (!chunk) { player.audio = null; return; }
+    player.audio = new Audio(chunk.src);
+    player.audio.onended = playNext;
+    player.audio.onerror = playNext;
+    player.audio.play().catch(playNext);
+  }
+  player.push = function(chunk) {
+    if (player.seen.has(chunk.id)) return;
+    player.seen.add(chunk.id);
+    if (chunk.utterance !== player.utterance) {
+      // a new answer interrupts the previous one
+      player.utterance = chunk.utterance;
+      player.queue = [];
+      if (player.audio) { player.audio.onended = null; player.audio.pause(); player.audio = null; }
+    }
+    player.queue.push(chunk);
+    if (!player.audio) playNext();
+  };
+  return player;
+})();
+"""
 
-        audio_info = mutagen.mp3.MP3(temp_path)
-        duration = math.ceil(audio_info.info.length)
+TTS_CHUNK_HTML = """
+<script>
+const chunk = __CHUNK__;
+try {
+  const host = window.parent;
+  if (!host.__ttsPlayer) {
+    const script = host.document.createElement("script");
+    script.textContent = __PLAYER__;
+    host.document.head.appendChild(script);
+  }
+  host.__ttsPlayer.push(chunk);
+} catch (e) {
+  new Audio(chunk.src).play();
+}
+</script>
+"""
+
+def split_sentences(text, max_chars=TTS_CHUNK_CHARS):
+    # The first sentence goes out alone so playback starts as early as
+    # possible; later ones are grouped to keep the number of requests down.
+    sentences = [s for s in re.split(r"(?<=[.!?。！？؟])\s+", text) if s.strip()]
+    chunks = []
+    for sentence in sentences:
+        if len(chunks) > 1 and len(chunks[-1]) + len(sentence) < max_chars:
+            chunks[-1] += " " + sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+def synthesize_speech(text, lang):
+    cache = get_audio_cache()
+    audio = cache.get(lang, text)
+    if audio is None:
+        buffer = io.BytesIO()
+        from gtts import gTTS
+        gTTS(text=text, lang=lang).write_to_fp(buffer)
+        audio = buffer.getvalue()
+        cache.put(lang, text, audio)
+    return audio
+
+@st.cache_resource(show_spinner=False)
+def get_tts_executor():
+    return ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+MP3_KBPS = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),  # MPEG-1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),  # MPEG-2
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),  # MPEG-2.5
+}
 
-        with open(temp_path, "rb") as f:
-            st.audio(f.read(), format="audio/mp3", autoplay=True)
+def mp3_duration(audio):
+    # gTTS returns constant-bitrate MP3, so the first frame header gives the
+    # bitrate of the whole clip.
+    offset = 0
+    if audio[:3] == b"ID3" and len(audio) >= 10:
+        offset = 10 + ((audio[6] & 0x7F) << 21 | (audio[7] & 0x7F) << 14 | (audio[8] & 0x7F) << 7 | (audio[9] & 0x7F))
+    start = audio.find(b"\xff", offset)
+    while 0 <= start < len(audio) - 2:
+        version, index = (audio[start + 1] >> 3) & 3, audio[start + 2] >> 4
+        if audio[start + 1] & 0xE0 == 0xE0 and version in MP3_KBPS and 0 < index < 15:
+            return (len(audio) - start) * 8 / (MP3_KBPS[version][index] * 1000)
+        start = audio.find(b"\xff", start + 1)
+    return len(audio) * 8 / 32000  # gTTS's usual 32 kbps
+
+def queue_playback(utterance_id, seconds):
+    # Tracks when the page player should fall silent, so the voice loop
+    # doesn't start listening while the answer is still being spoken.
+    now = time.monotonic()
+    if st.session_state.playback_utterance != utterance_id:
+        # a new answer interrupts the previous one
+        st.session_state.playback_utterance = utterance_id
+        st.session_state.playback_until = now
+    st.session_state.playback_until = max(st.session_state.playback_until, now) + seconds
+
+def playback_pending():
+    return time.monotonic() < st.session_state.playback_until + TTS_PLAYBACK_MARGIN
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def await_playback():
+    # Polls instead of sleeping, so Stop and the chat input keep working while
+    # the answer is spoken; the full rerun afterwards starts listening.
+    if not playback_pending():
+        st.rerun()
+    st.caption("🔊 Speaking...")
+
+def play_audio_chunk(audio, utterance_id, index):
+    queue_playback(utterance_id, mp3_duration(audio))
+    chunk = {
+        "id": f"{utterance_id}:{index}",
+        "utterance": utterance_id,
+        "src": "data:audio/mp3;base64," + base64.b64encode(audio).decode("ascii"),
+    }
+    html = TTS_CHUNK_HTML.replace("__PLAYER__", json.dumps(TTS_PLAYER_JS)).replace("__CHUNK__", json.dumps(chunk))
+    if hasattr(st, "iframe"):
+        # components.html is deprecated from the Streamlit release that added st.iframe
+        st.iframe(html, height="content")
+    else:
+        components.html(html, height=0)
+
+def synthesize_speech_chunks(text, lang, cancel_event=None):
+    # Yields the MP3 of each sentence chunk in order while the following ones
+    # are already being synthesized.
+    lines = text.split("\n")
+    clean_lines = [line for line in lines if "[" not in line and "http" not in line]
+    chunks = split_sentences(clean_text_for_tts(" ".join(clean_lines)))
+    futures = [get_tts_executor().submit(synthesize_speech, chunk, lang) for chunk in chunks]
+    try:
+        for future in futures:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            yield future.result(timeout=TTS_CHUNK_TIMEOUT)
+    finally:
+        for future in futures:
+            future.cancel()
 
-        time.sleep(duration + 0.3)
+def text_to_speech(text, lang='en'):
+    # Returns as soon as the last chunk is handed to the browser; playback
+    # itself never blocks the script.
+    utterance_id = uuid.uuid4().hex[:12]
+    try:
+        for index, audio in enumerate(synthesize_speech_chunks(text, lang)):
+            play_audio_chunk(audio, utterance_id, index)
     except Exception as e:
         st.error(f"TTS error: {e}")
 
-def speech_to_text(lang='en-US'):
-    r = sr.Recognizer()
-    r.pause_threshold = 4  # stop after 4 seconds of silence
-    with st.status("🎧 Listening...", expanded=True) as status:
-        try:
-            with sr.Microphone() as source:
-                r.adjust_for_ambient_noise(source)
-                audio = r.listen(source, timeout=10)
-            status.update(label="✅ Listening complete.", state="complete")
-            return r.recognize_google(audio, language=lang)
-        except sr.WaitTimeoutError:
-            status.update(label="🎧 Listening timed out (no speech detected).", state="complete")
-            return None
-        except Exception:
-            status.update(label="❌ Speech recognition failed.", state="error")
-            return None
-
 def open_browser_with_query(query):
     url = f"https://www.google.com/search?q={quote(query)}"
     subprocess.Popen(["start", "chrome", url], shell=True)
@@ -348,14 +1562,778 @@ def close_browser():
     subprocess.call(["taskkill", "/F", "/IM", "chrome.exe"], shell=True)
     st.session_state.browser_open = False
 
+# === Voice Input ===
+# The microphone is read in 30 ms frames. Ambient noise is measured once per
+# session; an utterance starts after a few frames well above it and ends
+# after VAD_HANGOVER of silence. Frames go to the recognizer as they arrive:
+# vosk decodes them as a stream, and recognizers that only take whole clips
+# get each stretch of speech sent at the next short pause, so transcription
+# runs while the user is still talking.
+@st.cache_resource(show_spinner=False)
+def get_stt_executor():
+    return ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix="stt")
+
+def frame_energy(frame):
+    samples = array("h", frame)
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples)) if samples else 0.0
+
+def recognize_google(audio, lang):
+    import speech_recognition as sr
+    try:
+        return sr.Recognizer().recognize_google(audio, language=lang)
+    except sr.UnknownValueError:
+        return ""
+
+def recognize_sphinx(audio, lang):
+    # pocketsphinx only ships an English model
+    import speech_recognition as sr
+    try:
+        return sr.Recognizer().recognize_sphinx(audio)
+    except sr.UnknownValueError:
+        return ""
+
+class SegmentedRecognizer:
+    def __init__(self, recognize, sample_rate, sample_width, lang):
+        self.recognize = recognize
+        self.sample_rate, self.sample_width, self.lang = sample_rate, sample_width, lang
+        self.frames, self.voiced, self.futures = [], False, []
+
+    def feed(self, frame, loud, pause):
+        self.frames.append(frame)
+        self.voiced = self.voiced or loud
+        seconds = len(self.frames) * len(frame) / self.sample_width / self.sample_rate
+        if pause and self.voiced and seconds >= STT_SEGMENT_MIN_SECONDS:
+            self.flush()
+
+    def flush(self):
+        import speech_recognition as sr
+        audio = sr.AudioData(b"".join(self.frames), self.sample_rate, self.sample_width)
+        self.futures.append(get_stt_executor().submit(self.recognize, audio, self.lang))
+        self.frames, self.voiced = [], False
+
+    def finish(self):
+        if self.voiced:
+            self.flush()
+        return " ".join(filter(None, (future.result(timeout=STT_TIMEOUT).strip() for future in self.futures)))
+
+@st.cache_resource(show_spinner=False)
+def get_vosk_model(lang):
+    from vosk import Model
+    return Model(VOSK_MODEL_PATH) if VOSK_MODEL_PATH else Model(lang=lang.lower())
+
+class VoskRecognizer:
+    def __init__(self, sample_rate, sample_width, lang):
+        from vosk import KaldiRecognizer
+        self.recognizer = KaldiRecognizer(get_vosk_model(lang), sample_rate)
+
+    def feed(self, frame, loud, pause):
+        self.recognizer.AcceptWaveform(frame)
+
+    def finish(self):
+        return json.loads(self.recognizer.FinalResult()).get("text", "")
+
+# name -> factory(sample_rate, sample_width, lang); vosk and sphinx work offline
+STT_BACKENDS = {
+    "google": partial(SegmentedRecognizer, recognize_google),
+    "vosk": VoskRecognizer,
+    "sphinx": partial(SegmentedRecognizer, recognize_sphinx),
+}
+
+def calibrate_noise(source):
+    frames = max(1, int(VOICE_CALIBRATION_SECONDS * source.SAMPLE_RATE / source.CHUNK))
+    return sum(frame_energy(source.stream.read(source.CHUNK)) for _ in range(frames)) / frames
+
+def listen_for_utterance(source, noise_floor, recognizer, on_speech=None):
+    # Returns the transcript, or None if nobody spoke within VOICE_LISTEN_TIMEOUT.
+    frame_seconds = source.CHUNK / source.SAMPLE_RATE
+    threshold = max(VAD_MIN_ENERGY, noise_floor * VAD_ENERGY_RATIO)
+    preroll = deque(maxlen=int(VAD_PREROLL / frame_seconds) + 1)
+    loud_frames = silent_frames = 0
+    waited = spoken = 0.0
+    while True:
+        frame = source.stream.read(source.CHUNK)
+        loud = frame_energy(frame) > threshold
+        if spoken == 0.0:
+            preroll.append(frame)
+            loud_frames = loud_frames + 1 if loud else 0
+            waited += frame_seconds
+            if loud_frames >= VAD_START_FRAMES:
+                for earlier in preroll:
+                    recognizer.feed(earlier, True, False)
+                spoken = len(preroll) * frame_seconds
+                if on_speech:
+                    on_speech()
+            elif waited > VOICE_LISTEN_TIMEOUT:
+                return None
+            continue
+        silent_frames = 0 if loud else silent_frames + 1
+        recognizer.feed(frame, loud, silent_frames * frame_seconds >= STT_SEGMENT_PAUSE)
+        spoken += frame_seconds
+        if silent_frames * frame_seconds >= VAD_HANGOVER or spoken >= VOICE_MAX_SECONDS:
+            return recognizer.finish()
+
+def speech_to_text(lang='en-US'):
+    import speech_recognition as sr
+    with st.status("🎧 Listening...", expanded=True) as status:
+        try:
+            with sr.Microphone(sample_rate=VOICE_SAMPLE_RATE, chunk_size=VOICE_FRAME_SAMPLES) as source:
+                if st.session_state.voice_noise_floor is None:
+                    st.session_state.voice_noise_floor = calibrate_noise(source)
+                backend = STT_BACKENDS.get(st.session_state.stt_backend, STT_BACKENDS["google"])
+                text = listen_for_utterance(
+                    source, st.session_state.voice_noise_floor, backend(source.SAMPLE_RATE, source.SAMPLE_WIDTH, lang),
+                    on_speech=lambda: status.update(label="🗣️ Listening and transcribing..."),
+                )
+            if text is None:
+                status.update(label="🎧 Listening timed out (no speech detected).", state="complete")
+                return None
+            status.update(label="✅ Listening complete.", state="complete")
+            return text or None
+        except Exception:
+            status.update(label="❌ Speech recognition failed.", state="error")
+            return None
+
 # === Chat history rendering ===
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
+def format_message_markdown(content):
+    # Streamlit reads "$...$" as LaTeX, which mangles prices in answers.
+    return re.sub(r"(?<!\\)\$", r"\\$", content)
+
+def render_transcript():
+    # Only the newest messages are rendered, so a rerun costs the same however
+    # long the chat is. Formatted markdown is cached for the visible window only.
+    messages = st.session_state.messages
+    start = max(0, len(messages) - st.session_state.transcript_window)
+    if start and st.button(f"⬆️ Load earlier messages ({start} hidden)", key="load_earlier"):
+        st.session_state.transcript_window += TRANSCRIPT_WINDOW
+        st.rerun()
+
+    cache = st.session_state.rendered_markdown
+    rendered = {}
+    for msg in messages[start:]:
+        content = msg["content"]
+        rendered[content] = cache.get(content) or format_message_markdown(content)
+        with st.chat_message(msg["role"]):
+            st.markdown(rendered[content])
+    st.session_state.rendered_markdown = rendered
 
 def clean_ai_response(text):
     return re.sub(r'^(Assistant|assistant):\s*', '', text).strip()
 
+# === Chat Archive ===
+# Archived chats stay as JSON files; archive.db indexes their titles,
+# timestamps, message counts and full text, so the sidebar never has to list
+# or open the files themselves.
+@contextmanager
+def archive_db():
+    conn = sqlite3.connect(archive_db_file, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def chat_title(messages):
+    for msg in messages:
+        if msg["role"] == "user":
+            title = re.sub(r"\s+", " ", msg["content"].replace("🎤", "")).strip()
+            return title[:60] + ("…" if len(title) > 60 else "")
+    return "Untitled chat"
+
+def index_archived_chat(conn, fts_enabled, chat_id, path, messages, created_at, owner):
+    conn.execute(
+        "INSERT OR REPLACE INTO chats (id, owner, path, title, created_at, updated_at, message_count) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (chat_id, owner, path.name, chat_title(messages), created_at, created_at, len(messages)),
+    )
+    if fts_enabled:
+        conn.execute("DELETE FROM chats_fts WHERE id = ?", (chat_id,))
+        conn.execute(
+            "INSERT INTO chats_fts (id, title, body) VALUES (?, ?, ?)",
+            (chat_id, chat_title(messages), "\n".join(msg["content"] for msg in messages)),
+        )
+        unindex_chat_messages(conn, chat_id)
+        index_chat_messages(conn, owner, chat_id, messages)
+
+def save_archived_chat(conn, fts_enabled, messages, owner, when):
+    # the random suffix keeps two sessions archiving in the same second apart
+    chat_id = f"{when:%Y-%m-%d_%H-%M-%S}_{uuid.uuid4().hex[:6]}"
+    path = archive_dir / f"chat_{chat_id}.json"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(messages, f, ensure_ascii=False, indent=2)
+    index_archived_chat(conn, fts_enabled, chat_id, path, messages, when.strftime("%Y-%m-%d %H:%M:%S"), owner)
+
+def archive_legacy_history(conn, fts_enabled):
+    # The shared <user>_chat_history file from before per-session stores
+    # becomes one archived chat of the local user. The files are renamed,
+    # not deleted, and the rename also keeps a second process from
+    # importing them again.
+    messages, modified = [], None
+    for path in legacy_history_files:
+        claimed = path.with_name(path.name + ".migrated")
+        try:
+            os.replace(path, claimed)
+        except OSError:
+            continue
+        if messages:
+            continue  # the .json is an older copy of the .jsonl journal
+        try:
+            if path.suffix == ".jsonl":
+                messages = load_journal(claimed)[0]
+            else:
+                with open(claimed, "r", encoding="utf-8") as f:
+                    messages = json.load(f)
+            modified = datetime.fromtimestamp(claimed.stat().st_mtime)
+        except (OSError, ValueError):
+            messages = []
+    if messages:
+        save_archived_chat(conn, fts_enabled, messages, local_user_id, modified)
+
+@st.cache_resource(show_spinner=False)
+def get_archive_index():
+    # Creates the schema and indexes archive files the database doesn't know
+    # about yet (older archives, or files copied in by hand). Returns whether
+    # full-text search is available.
+    with archive_db() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "id TEXT PRIMARY KEY, owner TEXT NOT NULL DEFAULT '', path TEXT NOT NULL, title TEXT NOT NULL, "
+            "created_at TEXT NOT NULL, updated_at TEXT NOT NULL, message_count INTEGER NOT NULL)"
+        )
+        if "owner" not in {row["name"] for row in conn.execute("PRAGMA table_info(chats)")}:
+            # archives indexed before chats had owners belong to the local user
+            conn.execute("ALTER TABLE chats ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            conn.execute("UPDATE chats SET owner = ?", (local_user_id,))
+        conn.execute("CREATE INDEX IF NOT EXISTS chats_owner_created ON chats (owner, created_at)")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(id UNINDEXED, title, body)")
+            fts_enabled = True
+        except sqlite3.OperationalError:
+            fts_enabled = False
+        if fts_enabled and not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_index'").fetchone():
+            # where each indexed exchange came from, so a chat's rows can be
+            # found without scanning the unindexed columns of messages_fts
+            conn.execute("CREATE TABLE message_index (id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, position INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX message_index_chat ON message_index (chat_id, position)")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+                conn.execute("INSERT INTO message_index (id, chat_id, position) SELECT rowid, chat_id, position FROM messages_fts")
+        if fts_enabled and not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            conn.execute(
+                "CREATE VIRTUAL TABLE messages_fts USING fts5(owner UNINDEXED, chat_id UNINDEXED, position UNINDEXED, content)"
+            )
+            # first start with local retrieval: index what was archived so far
+            for row in conn.execute("SELECT id, owner, path FROM chats").fetchall():
+                try:
+                    with open(archive_dir / row["path"], "r", encoding="utf-8") as f:
+                        index_chat_messages(conn, row["owner"], row["id"], json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        known = {row["path"] for row in conn.execute("SELECT path FROM chats")}
+        for path in archive_dir.glob("chat_*.json"):
+            if path.name in known:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    messages = json.load(f)
+            except (OSError, ValueError):
+                continue
+            chat_id = path.stem.replace("chat_", "")
+            try:
+                created = datetime.strptime(chat_id[:19], "%Y-%m-%d_%H-%M-%S")
+            except ValueError:
+                created = datetime.fromtimestamp(path.stat().st_mtime)
+            index_archived_chat(
+                conn, fts_enabled, chat_id, path, messages, created.strftime("%Y-%m-%d %H:%M:%S"), local_user_id
+            )
+        archive_legacy_history(conn, fts_enabled)
+    return fts_enabled
+
+def archive_chat():
+    if st.session_state.messages:
+        fts_enabled = get_archive_index()
+        with archive_db() as conn:
+            save_archived_chat(conn, fts_enabled, st.session_state.messages, st.session_state.user_id, datetime.now())
+
+def fts_query(text):
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+def list_archived_chats(query, page):
+    fts_enabled = get_archive_index()
+    offset = page * ARCHIVE_PAGE_SIZE
+    owner = st.session_state.user_id
+    columns = "chats.id, chats.path, chats.title, chats.updated_at, chats.message_count"
+    with archive_db() as conn:
+        if query.strip() and fts_enabled and fts_query(query):
+            match = fts_query(query)
+            total = conn.execute(
+                "SELECT COUNT(*) FROM chats_fts JOIN chats ON chats.id = chats_fts.id "
+                "WHERE chats_fts MATCH ? AND chats.owner = ?",
+                (match, owner),
+            ).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {columns} FROM chats_fts JOIN chats ON chats.id = chats_fts.id "
+                "WHERE chats_fts MATCH ? AND chats.owner = ? ORDER BY bm25(chats_fts) LIMIT ? OFFSET ?",
+                (match, owner, ARCHIVE_PAGE_SIZE, offset),
+            ).fetchall()
+        elif query.strip():
+            like = f"%{query.strip()}%"
+            total = conn.execute(
+                "SELECT COUNT(*) FROM chats WHERE owner = ? AND title LIKE ?", (owner, like)
+            ).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {columns} FROM chats WHERE owner = ? AND title LIKE ? "
+                "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (owner, like, ARCHIVE_PAGE_SIZE, offset),
+            ).fetchall()
+        else:
+            total = conn.execute("SELECT COUNT(*) FROM chats WHERE owner = ?", (owner,)).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {columns} FROM chats WHERE owner = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (owner, ARCHIVE_PAGE_SIZE, offset),
+            ).fetchall()
+    return rows, total
+
+def rename_archived_chat(chat_id, title):
+    fts_enabled = get_archive_index()
+    with archive_db() as conn:
+        updated = conn.execute(
+            "UPDATE chats SET title = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            (title, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), chat_id, st.session_state.user_id),
+        ).rowcount
+        if fts_enabled and updated:
+            conn.execute("UPDATE chats_fts SET title = ? WHERE id = ?", (title, chat_id))
+
+def delete_archived_chat(chat_id):
+    fts_enabled = get_archive_index()
+    with archive_db() as conn:
+        row = conn.execute(
+            "SELECT path FROM chats WHERE id = ? AND owner = ?", (chat_id, st.session_state.user_id)
+        ).fetchone()
+        if not row:
+            return
+        (archive_dir / row["path"]).unlink(missing_ok=True)
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        if fts_enabled:
+            conn.execute("DELETE FROM chats_fts WHERE id = ?", (chat_id,))
+            unindex_chat_messages(conn, chat_id)
+
+# === Local Retrieval ===
+# messages_fts (in archive.db) holds every question/answer exchange of the
+# user's archived chats and of the live conversation, ranked with bm25, and
+# message_index maps its rowids back to chats and positions. When
+# earlier exchanges already cover a question, the turn skips the web search;
+# questions about anything current always search.
+def live_chat_id(conversation_id):
+    return f"live:{conversation_id}"
+
+def chat_exchanges(messages, start=0):
+    for position in range(start, len(messages) - 1):
+        question, answer = messages[position], messages[position + 1]
+        if question["role"] == "user" and answer["role"] == "assistant" and not answer["content"].startswith("❌"):
+            yield position, f"Q: {question['content'].replace('🎤', '').strip()}\nA: {answer['content']}"
+
+def index_chat_messages(conn, owner, chat_id, messages, start=0):
+    for position, text in chat_exchanges(messages, start):
+        rowid = conn.execute(
+            "INSERT INTO message_index (chat_id, position) VALUES (?, ?)", (chat_id, position)
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO messages_fts (rowid, owner, chat_id, position, content) VALUES (?, ?, ?, ?, ?)",
+            (rowid, owner, chat_id, position, text),
+        )
+
+def unindex_chat_messages(conn, chat_id):
+    conn.execute("DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM message_index WHERE chat_id = ?)", (chat_id,))
+    conn.execute("DELETE FROM message_index WHERE chat_id = ?", (chat_id,))
+
+def index_live_messages(state):
+    # Adds the exchanges delivered since the previous turn.
+    if not get_archive_index():
+        return
+    chat_id = live_chat_id(state["conversation_id"])
+    with archive_db() as conn:
+        indexed = conn.execute("SELECT MAX(position) FROM message_index WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        index_chat_messages(conn, state["user_id"], chat_id, state["messages"], 0 if indexed is None else indexed + 1)
+
+def forget_live_messages(conversation_id):
+    # the live conversation was cleared or replaced; archived copies stay indexed
+    if get_archive_index():
+        with archive_db() as conn:
+            unindex_chat_messages(conn, live_chat_id(conversation_id))
+
+def query_terms(text):
+    # numbers are kept whatever their length: they're what tells "the 2018
+    # final" from "the 2022 final"
+    return [
+        word for word in dict.fromkeys(re.findall(r"\w+", text.casefold()))
+        if word not in LOCAL_STOP_WORDS and (len(word) > 2 or word.isdigit())
+    ]
+
+def term_found(term, words):
+    if term.isdigit():
+        return term in words
+    return any(word.startswith(term) for word in words)
+
+def is_time_sensitive(text):
+    return bool(TIME_SENSITIVE_WORDS & set(re.findall(r"\w+", text.casefold())))
+
+def search_local_context(text, state):
+    # Returns the best earlier exchanges for this question, and whether one of
+    # them contains every term of it (numbers word for word), which is when
+    # the web search is skipped. Messages still in the prompt window are left
+    # out, the model sees them anyway.
+    terms = query_terms(text)
+    if not terms or not get_archive_index():
+        return [], False
+    with archive_db() as conn:
+        rows = conn.execute(
+            "SELECT content FROM messages_fts WHERE messages_fts MATCH ? AND owner = ? "
+            "AND NOT (chat_id = ? AND position >= ?) ORDER BY bm25(messages_fts) LIMIT ?",
+            (" OR ".join(f'"{term}"*' for term in terms), state["user_id"],
+             live_chat_id(state["conversation_id"]), state["summary_upto"], LOCAL_CONTEXT_K),
+        ).fetchall()
+    snippets, covered = [], False
+    for row in rows:
+        words = set(re.findall(r"\w+", row["content"].casefold()))
+        found = sum(term_found(term, words) for term in terms)
+        snippet = row["content"][:LOCAL_SNIPPET_CHARS]
+        if found / len(terms) >= LOCAL_SNIPPET_MIN_COVERAGE and snippet not in snippets:
+            snippets.append(snippet)
+            covered = covered or found == len(terms)
+    enough = covered and len(terms) >= 2 and not is_time_sensitive(text)
+    return snippets, enough
+
+# === Turn Pipeline ===
+@st.cache_resource(show_spinner=False)
+def get_stage_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="turn-stage")
+
+def run_stages(stages, turn_id=None):
+    # stages: {name: (fn, args, timeout, fallback)}. All stages start at once;
+    # a stage that raises or misses its deadline yields its fallback instead.
+    # Stage functions run off the script thread and must not call st.*.
+    executor = get_stage_executor()
+    started = time.monotonic()
+    finished_at = {}
+    futures = {}
+    for name, (fn, args, _, _) in stages.items():
+        futures[name] = executor.submit(fn, *args)
+        futures[name].add_done_callback(lambda _, name=name: finished_at.setdefault(name, time.monotonic()))
+    results, failed = {}, {}
+    for name, (_, _, timeout, fallback) in stages.items():
+        remaining = max(0.0, timeout - (time.monotonic() - started))
+        try:
+            results[name] = futures[name].result(timeout=remaining)
+        except Exception as e:
+            futures[name].cancel()
+            results[name] = fallback
+            failed[name] = e if str(e) else "timed out"
+        status = "ok" if name not in failed else ("timeout" if name not in finished_at else "error")
+        record_span(turn_id, name, finished_at.get(name, started + timeout) - started, status=status)
+    return results, failed
+
+def translate_to_english(text):
+    return translate_text(text, "en")
+
+# === Background Turns ===
+# Turns run on a shared worker pool, off the script thread, so the UI stays
+# responsive and a rerun never restarts half-done work. Each browser session
+# has a FIFO of jobs in a process-wide registry; the head job runs while a
+# fragment polls it for streamed text and audio, and the finished result is
+# written to history at the top of the next full run.
+class TurnJob:
+    def __init__(self, kind, key, text, from_voice):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.text = text
+        self.from_voice = from_voice
+        self.display_input = f"🎤 {text}" if from_voice else text
+        self.status = "queued"
+        self.stage = "⏳ Waiting for the previous message..."
+        self.state = None
+        self.partial = ""
+        self.response = ""
+        self.user_message = None
+        self.assistant_message = None
+        self.warnings = []
+        self.audio = []
+        self.audio_emitted = 0
+        self.cancel_event = threading.Event()
+        self.first_token_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    def finish(self, status):
+        self.status = status
+        self.finished_at = time.time()
+
+@st.cache_resource(show_spinner=False)
+def get_job_registry():
+    return {
+        "lock": threading.Lock(),
+        "sessions": {},
+        "executor": ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="turn-job"),
+    }
+
+def session_jobs():
+    registry = get_job_registry()
+    with registry["lock"]:
+        return list(registry["sessions"].get(st.session_state.session_id, []))
+
+def snapshot_turn_state():
+    return {
+        "messages": list(st.session_state.messages),
+        "tts_lang": st.session_state.tts_lang,
+        "stream_responses": st.session_state.stream_responses,
+        "history_token_budget": st.session_state.history_token_budget,
+        "summarize_history": st.session_state.summarize_history,
+        "history_summary": st.session_state.history_summary,
+        "summary_upto": st.session_state.summary_upto,
+        "prompt_stats": {},
+        "session_id": st.session_state.session_id,
+        "conversation_id": st.session_state.conversation_id,
+        "user_id": st.session_state.user_id,
+    }
+
+def start_job(job):
+    # History is snapshotted when the job starts rather than when it was
+    # queued, so it includes the turns delivered before it.
+    job.state = snapshot_turn_state()
+    job.status = "running"
+    get_job_registry()["executor"].submit(run_turn_job, job)
+
+def submit_turn(kind, text, from_voice=False):
+    registry = get_job_registry()
+    key = f"{kind}:{text.strip()}"
+    now = time.time()
+    with registry["lock"]:
+        for session_id, jobs in list(registry["sessions"].items()):
+            jobs[:] = [job for job in jobs if not job.finished or now - job.finished_at < JOB_RETENTION]
+            if not jobs:
+                del registry["sessions"][session_id]
+        jobs = registry["sessions"].setdefault(st.session_state.session_id, [])
+        for job in jobs:
+            if job.key == key and not job.finished:
+                return job  # same message submitted twice
+        job = TurnJob(kind, key, text, from_voice)
+        jobs.append(job)
+        start_now = len(jobs) == 1
+    if start_now:
+        start_job(job)
+    return job
+
+def cancel_job(job):
+    job.cancel_event.set()
+    if job.status == "queued":
+        job.finish("cancelled")
+
+def drop_session_jobs():
+    registry = get_job_registry()
+    with registry["lock"]:
+        jobs = registry["sessions"].pop(st.session_state.session_id, [])
+    for job in jobs:
+        cancel_job(job)
+
+def stream_into_job(job, messages, model=OLLAMA_MODEL):
+    chunks = stream_ollama_response(
+        messages, stats=job.state["prompt_stats"], session=job.state["session_id"], model=model,
+        cancel_event=job.cancel_event,
+    )
+    try:
+        for chunk in chunks:
+            if not job.partial:
+                job.first_token_at = time.perf_counter()
+            job.partial += chunk
+            if job.cancel_event.is_set():
+                break
+    except Exception as e:
+        if not job.partial:
+            return f"❌ Error: {e}"
+        job.partial += "\n\n⚠️ _Connection to Ollama was lost, this answer is incomplete._"
+    finally:
+        # closing the stream makes Ollama stop generating
+        chunks.close()
+    return job.partial
+
+def speak_into_job(job, text):
+    job.stage = "🔈 Preparing speech..."
+    with trace_span(job.id, "tts") as span:
+        started = time.perf_counter()
+        try:
+            for audio in synthesize_speech_chunks(text, job.state["tts_lang"], job.cancel_event):
+                if not job.audio:
+                    span["first_chunk_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                job.audio.append(audio)
+        except Exception as e:
+            span["status"] = "error"
+            job.warnings.append(f"TTS error: {e}")
+        span["chunks"] = len(job.audio)
+
+def run_chat_job(job):
+    state = job.state
+    job.stage = "🗂️ Checking earlier chats..."
+    with trace_span(job.id, "local_search") as span:
+        try:
+            index_live_messages(state)
+            local_context, local_enough = search_local_context(job.text, state)
+        except sqlite3.Error:
+            span["status"] = "error"
+            local_context, local_enough = [], False
+        span.update(hits=len(local_context), skipped_web=local_enough)
+
+    stages = {"translate": (translate_to_english, (job.text,), TRANSLATE_STAGE_TIMEOUT, job.text)}
+    if local_enough:
+        job.stage = "🌍 Translating..."
+    else:
+        job.stage = "🔍 Searching the web and translating..."
+        stages["search"] = (perform_web_search, (job.text,), SEARCH_STAGE_TIMEOUT, None)
+    results, failed = run_stages(stages, turn_id=job.id)
+    search_results = results.get("search")
+    translated = results["translate"] or job.text
+    if "translate" in failed:
+        job.warnings.append(f"Translation unavailable ({failed['translate']}), your message was sent as written.")
+
+    job.user_message = {
+        "role": "user",
+        "content": job.display_input,
+        "llm_content": build_user_turn(translated, search_results=search_results, local_context=local_context),
+    }
+    state["messages"].append(job.user_message)
+
+    def on_summarize():
+        job.stage = "🧠 Summarizing earlier messages..."
+
+    with trace_span(job.id, "history"):
+        update_history_window(state, on_summarize)
+        chat_messages = build_chat_messages(state)
+    job.stage = "💡 AI is thinking..."
+    model = pick_model(job.text)
+    with trace_span(job.id, "ollama", streamed=state["stream_responses"], model=model) as span:
+        started = time.perf_counter()
+        if state["stream_responses"]:
+            response_en = stream_into_job(job, chat_messages, model)
+        else:
+            try:
+                response_en = generate_ollama_response(
+                    chat_messages, stats=state["prompt_stats"], session=state["session_id"], model=model
+                ) or "No response from Ollama."
+            except Exception as e:
+                response_en = f"❌ Error: {e}"
+        if job.first_token_at:
+            span["first_token_ms"] = round((job.first_token_at - started) * 1000, 1)
+        span.update(state["prompt_stats"])
+    record_ollama_spans(job.id, state["prompt_stats"])
+
+    if job.cancel_event.is_set():
+        stopped_text = clean_ai_response(job.partial)
+        if stopped_text:
+            job.assistant_message = {
+                "role": "assistant",
+                "content": stopped_text + "\n\n⏹ _Stopped._",
+                "llm_content": stopped_text,
+            }
+        job.finish("cancelled")
+        return
+
+    response_en = clean_ai_response(response_en)
+    job.stage = "🌍 Translating the answer..."
+    with trace_span(job.id, "translate_output") as span:
+        try:
+            response_final = translate_long_text(response_en, state["tts_lang"], source="en")
+        except Exception:
+            span["status"] = "error"
+            response_final = response_en
+    job.response = response_final
+    job.assistant_message = {"role": "assistant", "content": response_final}
+    if response_final != response_en:
+        job.assistant_message["llm_content"] = response_en
+    speak_into_job(job, response_final)
+
+def run_news_job(job):
+    job.stage = "📰 Reading today's local news..."
+    with trace_span(job.id, "news"):
+        news = get_local_news_summary(lang=job.state["tts_lang"])
+    job.response = news
+    job.assistant_message = {"role": "assistant", "content": news}
+    speak_into_job(job, news)
+
+def run_turn_job(job):
+    # Runs on a worker thread: everything it needs is in job.state, and it
+    # must not touch st.* or st.session_state.
+    started = time.perf_counter()
+    try:
+        if job.kind == "news":
+            run_news_job(job)
+        else:
+            run_chat_job(job)
+        if not job.finished:
+            job.finish("done")
+    except Exception as e:
+        job.assistant_message = {"role": "assistant", "content": f"❌ Error: {e}"}
+        job.finish("failed")
+    record_span(job.id, "turn", time.perf_counter() - started, kind=job.kind, status=job.status)
+
+def deliver_finished_jobs():
+    # Runs at the top of every full run: moves finished turns into history
+    # and starts the next queued one.
+    registry = get_job_registry()
+    with registry["lock"]:
+        jobs = registry["sessions"].get(st.session_state.session_id, [])
+        delivered = []
+        while jobs and jobs[0].finished and jobs[0].audio_emitted >= len(jobs[0].audio):
+            delivered.append(jobs.pop(0))
+        next_job = jobs[0] if jobs and jobs[0].status == "queued" else None
+
+    for job in delivered:
+        if job.user_message:
+            append_message(job.user_message)
+        if job.assistant_message:
+            append_message(job.assistant_message)
+        if job.state and job.status != "cancelled":
+            st.session_state.history_summary = job.state["history_summary"]
+            st.session_state.summary_upto = job.state["summary_upto"]
+            st.session_state.prompt_stats = job.state["prompt_stats"]
+        for warning in job.warnings:
+            st.warning(warning)
+        if job.from_voice:
+            st.session_state.processing_voice = False
+    if next_job:
+        start_job(next_job)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_active_job():
+    jobs = session_jobs()
+    if not jobs:
+        return
+    job = jobs[0]
+    if job.kind == "chat":
+        with st.chat_message("user"):
+            st.markdown(format_message_markdown(job.display_input))
+    with st.chat_message("assistant"):
+        text = job.response or job.partial
+        if text:
+            st.markdown(format_message_markdown(text) + ("" if job.finished else "▌"))
+        if not job.finished:
+            st.caption(job.stage)
+            if st.button("⏹ Stop generating", key=f"stop_{job.id}"):
+                cancel_job(job)
+    if len(jobs) > 1:
+        st.caption(f"⏳ {len(jobs) - 1} more message(s) queued")
+
+    # Audio is handed to the page player as soon as each chunk is ready; the
+    # turn is only collected once every chunk has been sent.
+    emitted = job.audio_emitted
+    for index in range(emitted, len(job.audio)):
+        play_audio_chunk(job.audio[index], job.id, index)
+    job.audio_emitted = len(job.audio)
+    if job.finished and job.audio_emitted == emitted:
+        st.rerun()
+
 def handle_input(user_input, from_voice=False):
     original = user_input.strip()
     if not original:
@@ -369,21 +2347,17 @@ def handle_input(user_input, from_voice=False):
         return
 
     if "what did you learn today" in original.lower():
-        news = get_local_news_summary()
-        st.session_state.messages.append({"role": "assistant", "content": news})
-        with st.chat_message("assistant"):
-            st.markdown(news)
-        text_to_speech(news, lang=st.session_state.tts_lang)
-        if from_voice:
-            st.session_state.processing_voice = False
-        st.rerun()
+        submit_turn("news", original, from_voice=from_voice)
         return
 
     if "open browser" in original.lower():
         query = original.lower().replace("open browser", "").strip()
         open_browser_with_query(query or "")
-        message = f"🧭 Opening browser{' and searching for: **' + query + '**' if query else '.'}"
-        st.session_state.messages.append({"role": "assistant", "content": message})
+        if query:
+            message = f"🧭 {translate_canned('Opening browser and searching for:', st.session_state.tts_lang)} **{query}**"
+        else:
+            message = f"🧭 {translate_canned('Opening browser.', st.session_state.tts_lang)}"
+        append_message({"role": "assistant", "content": message})
         with st.chat_message("assistant"):
             st.markdown(message)
         text_to_speech(message, lang=st.session_state.tts_lang)
@@ -394,8 +2368,8 @@ def handle_input(user_input, from_voice=False):
 
     if "close browser" in original.lower():
         close_browser()
-        message = "❌ Browser closed."
-        st.session_state.messages.append({"role": "assistant", "content": message})
+        message = f"❌ {translate_canned('Browser closed.', st.session_state.tts_lang)}"
+        append_message({"role": "assistant", "content": message})
         with st.chat_message("assistant"):
             st.markdown(message)
         text_to_speech(message, lang=st.session_state.tts_lang)
@@ -404,45 +2378,7 @@ def handle_input(user_input, from_voice=False):
         st.rerun()
         return
 
-    with st.spinner("🔍 Performing web search..."):
-        search_results = perform_web_search(original)
-
-    try:
-        translated = GoogleTranslator(source='auto', target='en').translate(original)
-    except Exception as e:
-        st.error(f"Translation error: {e}")
-        if from_voice:
-            st.session_state.processing_voice = False
-        return
-
-    role_input = f"🎤 {original}" if from_voice else original
-    st.session_state.messages.append({"role": "user", "content": role_input})
-    save_history()
-
-    with st.chat_message("user"):
-        st.markdown(role_input)
-
-    with st.spinner("💡 AI is thinking..."):
-        response_en = clean_ai_response(
-            generate_ollama_response(translated, search_results=search_results)
-        )
-        try:
-            response_final = GoogleTranslator(source='en', target=st.session_state.tts_lang).translate(response_en)
-        except Exception:
-            response_final = response_en
-
-        st.session_state.messages.append({"role": "assistant", "content": response_final})
-        save_history()
-
-        with st.chat_message("assistant"):
-            st.markdown(response_final)
-
-        text_to_speech(response_final, lang=st.session_state.tts_lang)
-
-    if from_voice:
-        st.session_state.processing_voice = False
-
-    st.rerun()
+    submit_turn("chat", original, from_voice=from_voice)
 
 # === Empty-state hero (centered, no input) ===
 def render_home():
@@ -460,8 +2396,12 @@ def render_home():
     return None
 
 # === Main Application Logic ===
+warm_up_model()
+deliver_finished_jobs()
+render_transcript()
+
 new_query = None
-if not st.session_state.messages:
+if not st.session_state.messages and not session_jobs():
     new_query = render_home()
 
 if new_query:
@@ -472,13 +2412,19 @@ if prompt := st.chat_input("Type your message here..."):
         st.session_state.voice_mode = False
         handle_input(prompt)
 
+if session_jobs():
+    render_active_job()
+
 # === Voice loop ===
-if st.session_state.voice_mode and not st.session_state.processing_voice:
+if st.session_state.voice_mode and not st.session_state.processing_voice and playback_pending():
+    await_playback()
+elif st.session_state.voice_mode and not st.session_state.processing_voice:
     st.session_state.processing_voice = True
     speech = speech_to_text(lang=st.session_state.lang_code)
     if speech:
         handle_input(speech, from_voice=True)
         st.session_state.speech_failed_count = 0
+        st.rerun()
     else:
         st.session_state.processing_voice = False
         st.session_state.speech_failed_count += 1
@@ -496,6 +2442,10 @@ lang_map = {
 }
 st.session_state.lang_code = st.sidebar.selectbox("Speech Recognition Language", list(lang_map.keys()), index=0)
 st.session_state.tts_lang = lang_map.get(st.session_state.lang_code, "en")
+if st.session_state.stt_backend not in STT_BACKENDS:
+    st.session_state.stt_backend = "google"
+st.sidebar.selectbox("Speech recognizer", list(STT_BACKENDS), key="stt_backend", help="vosk and sphinx run offline")
+st.sidebar.toggle("⚡ Stream responses", key="stream_responses")
 
 if st.sidebar.button("🎤 Start Voice Chat"):
     st.session_state.voice_mode = True
@@ -507,46 +2457,113 @@ if st.sidebar.button("🛑 Stop Voice Chat"):
     st.session_state.processing_voice = False
     st.rerun()
 
-def archive_chat():
-    if st.session_state.messages:
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        with open(archive_dir / f"chat_{timestamp}.json", "w", encoding="utf-8") as f:
-            json.dump(st.session_state.messages, f, ensure_ascii=False, indent=2)
-
 if st.sidebar.button("🆕 New Chat"):
+    drop_session_jobs()
     archive_chat()
-    st.session_state.messages = []
-    save_history()
+    clear_history()
+    forget_live_messages(st.session_state.conversation_id)
+    reset_history_summary()
+    st.session_state.transcript_window = TRANSCRIPT_WINDOW
     st.rerun()
 
-st.sidebar.markdown("### 📁 Recent Chats")
-archive_files = sorted(archive_dir.glob("chat_*.json"), reverse=True)[:10]
+with st.sidebar.expander("📊 Caches"):
+    for label, cache in (("Web search", get_search_cache()), ("Translation", get_translation_cache())):
+        st.caption(
+            f"{label}: {len(cache)} entries · "
+            + " · ".join(f"{name.replace('_', ' ')} {count}" for name, count in cache.stats.items())
+        )
+    audio_cache = get_audio_cache()
+    st.caption(
+        f"Speech audio: {audio_cache.total_bytes / 1024 / 1024:.1f} MB · "
+        + " · ".join(f"{name} {count}" for name, count in audio_cache.stats.items())
+    )
 
-for file in archive_files:
-    file_id = file.stem.replace("chat_", "")
-    display_name = file_id.replace("_", " ")
+if login_available():
+    if st.user.is_logged_in:
+        st.sidebar.caption(f"👤 {st.user.get('name') or st.user.get('email')}")
+        if st.sidebar.button("🚪 Sign out"):
+            st.logout()
+    elif st.sidebar.button("🔑 Sign in to keep your chats private"):
+        st.login()
+
+st.sidebar.markdown("### 📁 Recent Chats")
+archive_query = st.sidebar.text_input("Search chats", key="archive_query", placeholder="🔎 Search chats")
+if archive_query != st.session_state.archive_last_query:
+    st.session_state.archive_last_query = archive_query
+    st.session_state.archive_page = 0
+archived_chats, archived_total = list_archived_chats(archive_query, st.session_state.archive_page)
+
+for chat in archived_chats:
+    chat_id = chat["id"]
     with st.sidebar.container():
         col1, col2, col3 = st.columns([6, 1, 1])
         with col1:
-            if st.button(f"🕘 {display_name}", key=f"load_{file_id}"):
-                with open(file, "r", encoding="utf-8") as f:
-                    st.session_state.messages = json.load(f)
-                save_history()
+            if st.button(f"🕘 {chat['title']}", key=f"load_{chat_id}", help=f"{chat['message_count']} messages · {chat['updated_at']}"):
+                drop_session_jobs()
+                with open(archive_dir / chat["path"], "r", encoding="utf-8") as f:
+                    replace_history(json.load(f))
+                forget_live_messages(st.session_state.conversation_id)
+                reset_history_summary()
+                st.session_state.transcript_window = TRANSCRIPT_WINDOW
                 st.rerun()
         with col2:
-            if st.button("✏️", key=f"rename_btn_{file_id}"):
-                st.session_state.rename_states[file_id] = not st.session_state.rename_states.get(file_id, False)
+            if st.button("✏️", key=f"rename_btn_{chat_id}"):
+                st.session_state.rename_states[chat_id] = not st.session_state.rename_states.get(chat_id, False)
         with col3:
-            if st.button("🗑️", key=f"delete_{file_id}"):
-                file.unlink()
+            if st.button("🗑️", key=f"delete_{chat_id}"):
+                delete_archived_chat(chat_id)
                 st.rerun()
 
-        if st.session_state.rename_states.get(file_id, False):
-            new_name = st.text_input("Rename chat", value=file_id, key=f"input_{file_id}")
-            clean_name = new_name.strip().replace(" ", "_").replace(":", "-")
-            if clean_name and clean_name != file_id:
-                new_path = archive_dir / f"chat_{clean_name}.json"
-                file.rename(new_path)
-                st.success(f"Renamed to {clean_name}")
-                st.session_state.rename_states[file_id] = False
+        if st.session_state.rename_states.get(chat_id, False):
+            new_name = st.text_input("Rename chat", value=chat["title"], key=f"input_{chat_id}")
+            if new_name.strip() and new_name.strip() != chat["title"]:
+                rename_archived_chat(chat_id, new_name.strip())
+                st.success(f"Renamed to {new_name.strip()}")
+                st.session_state.rename_states[chat_id] = False
                 st.rerun()
+
+if archived_total > ARCHIVE_PAGE_SIZE:
+    page_count = math.ceil(archived_total / ARCHIVE_PAGE_SIZE)
+    col1, col2, col3 = st.sidebar.columns([1, 2, 1])
+    with col1:
+        if st.button("◀", key="archive_prev", disabled=st.session_state.archive_page == 0):
+            st.session_state.archive_page -= 1
+            st.rerun()
+    with col2:
+        st.caption(f"Page {st.session_state.archive_page + 1} of {page_count}")
+    with col3:
+        if st.button("▶", key="archive_next", disabled=st.session_state.archive_page >= page_count - 1):
+            st.session_state.archive_page += 1
+            st.rerun()
+elif archive_query and not archived_chats:
+    st.sidebar.caption("No matching chats.")
+
+with st.sidebar.expander("⏱️ Diagnostics"):
+    rows = stage_percentiles()
+    if rows:
+        st.markdown(
+            "| Stage | n | p50 ms | p95 ms |\n|---|---:|---:|---:|\n"
+            + "\n".join(f"| {stage} | {count} | {p50:,.0f} | {p95:,.0f} |" for stage, count, p50, p95 in rows)
+        )
+    else:
+        st.caption("No turns measured yet.")
+    in_flight, queued = get_ollama_scheduler().snapshot()
+    st.caption(
+        " · ".join(f"`{backend}` {count}/{OLLAMA_BACKEND_SLOTS}" for backend, count in in_flight.items())
+        + f" · {queued} waiting"
+    )
+    st.caption(f"Spans are written to `{METRICS_FILE}`")
+
+with st.sidebar.expander("🧠 Memory"):
+    st.number_input(
+        "History token budget", min_value=256, max_value=OLLAMA_OPTIONS["num_ctx"],
+        step=256, key="history_token_budget",
+    )
+    st.toggle("Summarize older turns", key="summarize_history")
+    st.text_area("Summary of earlier turns", key="history_summary", height=150)
+    prompt_stats = st.session_state.prompt_stats
+    if prompt_stats:
+        line = f"Last prompt: ~{prompt_stats['estimated_tokens']} tokens estimated"
+        if "prompt_eval_count" in prompt_stats:
+            line += f", {prompt_stats['prompt_eval_count']} evaluated by Ollama"
+        st.caption(line)
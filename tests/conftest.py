@@ -0,0 +1,33 @@
+import ast
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+APP_FILE = Path(__file__).resolve().parent.parent / "ollama_chat_app.py"
+
+
+def passthrough_cache(**kwargs):
+    return lambda fn: fn
+
+
+def load_app(*names, **namespace):
+    # ollama_chat_app.py is a Streamlit script that builds the page when it is
+    # imported, so tests execute only its imports and the named top-level
+    # definitions, with anything else they touch passed in as stand-ins.
+    tree = ast.parse(APP_FILE.read_text(encoding="utf-8"))
+    namespace = {"st": SimpleNamespace(cache_resource=passthrough_cache), "contextmanager": contextmanager, **namespace}
+    for node in tree.body:
+        if isinstance(node, ast.Import | ast.ImportFrom):
+            module = node.module if isinstance(node, ast.ImportFrom) else node.names[0].name
+            if module.startswith("streamlit"):
+                continue
+        elif isinstance(node, ast.Assign):
+            if not any(getattr(target, "id", None) in names for target in node.targets):
+                continue
+        elif isinstance(node, ast.FunctionDef | ast.ClassDef):
+            if node.name not in names:
+                continue
+        else:
+            continue
+        exec(compile(ast.Module([node], []), str(APP_FILE), "exec"), namespace)
+    return SimpleNamespace(**namespace)
@@ -0,0 +1,105 @@
+import pytest
+import requests
+
+from conftest import load_app
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeSession:
+    def __init__(self):
+        self.outcome = None
+
+    def post(self, url, **kwargs):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome
+
+
+@pytest.fixture
+def app():
+    app = load_app("CircuitOpenError", "CircuitBreaker", "ollama_post", OLLAMA_TIMEOUT=5)
+    clock, session = FakeClock(), FakeSession()
+    breaker = app.CircuitBreaker("Ollama", threshold=2, cooldown=30)
+    # the loaded functions see the module namespace, so swap in the stand-ins there
+    app.ollama_post.__globals__.update(
+        time=clock, get_http_session=lambda: session, get_ollama_breaker=lambda backend: breaker,
+    )
+    app.clock, app.session, app.breaker = clock, session, breaker
+    return app
+
+
+def post(app, outcome):
+    app.session.outcome = outcome
+    return app.ollama_post("http://ollama", {})
+
+
+def open_breaker(app):
+    for _ in range(app.breaker.threshold):
+        with pytest.raises(requests.ConnectionError):
+            post(app, requests.ConnectionError())
+    assert app.breaker.is_open()
+
+
+def test_opens_after_consecutive_failures(app):
+    with pytest.raises(requests.ConnectionError):
+        post(app, requests.ConnectionError())
+    assert not app.breaker.is_open()
+    with pytest.raises(requests.Timeout):
+        post(app, requests.Timeout())
+    assert app.breaker.is_open()
+    with pytest.raises(app.CircuitOpenError):
+        post(app, "response")
+
+
+def test_success_resets_the_failure_count(app):
+    with pytest.raises(requests.ConnectionError):
+        post(app, requests.ConnectionError())
+    assert post(app, "response") == "response"
+    with pytest.raises(requests.ConnectionError):
+        post(app, requests.ConnectionError())
+    assert not app.breaker.is_open()
+
+
+def test_trial_after_cooldown_closes_on_success(app):
+    open_breaker(app)
+    app.clock.now += 31
+    assert not app.breaker.is_open()
+    assert post(app, "response") == "response"
+    assert app.breaker.opened_at is None and app.breaker.failures == 0
+
+
+def test_failed_trial_reopens_for_another_cooldown(app):
+    open_breaker(app)
+    app.clock.now += 31
+    with pytest.raises(requests.ConnectionError):
+        post(app, requests.ConnectionError())
+    assert app.breaker.is_open()
+    app.clock.now += 10
+    with pytest.raises(app.CircuitOpenError):
+        post(app, "response")
+
+
+def test_only_one_trial_at_a_time(app):
+    open_breaker(app)
+    app.clock.now += 31
+    app.breaker.before_call()
+    with pytest.raises(app.CircuitOpenError):
+        app.breaker.before_call()
+
+
+def test_unexpected_error_in_trial_releases_it(app):
+    open_breaker(app)
+    app.clock.now += 31
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        post(app, requests.exceptions.InvalidHeader())
+    assert not app.breaker.trial
+    # the next call is let through as a new trial instead of failing forever
+    assert post(app, "response") == "response"
+    assert not app.breaker.is_open()
@@ -0,0 +1,60 @@
+import functools
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import load_app
+
+
+class SessionState(dict):
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+@pytest.fixture
+def app(tmp_path):
+    st = SimpleNamespace(cache_resource=lambda **kwargs: functools.cache, session_state=SessionState())
+    app = load_app(
+        "HISTORY_STORE_SIZE", "conversation_key", "get_history_stores", "get_history_store",
+        st=st, sessions_dir=tmp_path, local_user_id="alice",
+    )
+    app.st = st
+    return app
+
+
+def open_session(app, user_id, history_id):
+    app.st.session_state.clear()
+    app.st.session_state.update(user_id=user_id, conversation_id=app.conversation_key(user_id, history_id))
+    return app.st.session_state
+
+
+def test_local_conversations_are_named_by_sid(app, tmp_path):
+    open_session(app, "alice", "abc")
+    assert app.get_history_store()["path"] == tmp_path / "abc.jsonl"
+
+
+def test_signed_in_accounts_dont_share_a_sid(app):
+    open_session(app, "user:bob@example.com", "abc")
+    bob = app.get_history_store()
+    open_session(app, "user:eve@example.com", "abc")
+    eve = app.get_history_store()
+    assert bob is not eve
+    assert bob["path"] != eve["path"]
+    assert bob["path"].name == eve["path"].name == "abc.jsonl"
+    assert bob["path"].parent.is_dir()
+
+
+def test_open_session_keeps_its_store_after_eviction(app):
+    open_session(app, "alice", "first")
+    store = app.get_history_store()
+    store["messages"].append({"role": "user", "content": "hi"})
+    first = dict(app.st.session_state)
+    for i in range(app.HISTORY_STORE_SIZE + 5):
+        open_session(app, "alice", f"other{i}")
+        app.get_history_store()
+    assert "first" not in app.get_history_stores()["stores"]
+
+    app.st.session_state.clear()
+    app.st.session_state.update(first)
+    assert app.get_history_store() is store
+    assert "first" in app.get_history_stores()["stores"]
@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+
+import pytest
+import requests
+
+from conftest import load_app
+
+SUMMARY_TEXT = "User asked about tides; assistant explained the moon's pull."
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        if isinstance(self.content, Exception):
+            raise self.content
+
+    def json(self):
+        return {"message": {"role": "assistant", "content": self.content}, "done": True}
+
+
+@contextmanager
+def ollama_slot(session, stats):
+    yield "http://ollama"
+
+
+@pytest.fixture
+def app():
+    app = load_app(
+        "SUMMARY_INPUT_CHARS", "HISTORY_KEEP_RATIO", "OLLAMA_MODEL", "generate_ollama_response",
+        "summarize_history", "update_history_window",
+        ollama_slot=ollama_slot,
+        build_ollama_payload=lambda messages, model: {"model": model, "messages": messages},
+        ollama_stats=lambda result: {},
+        clean_ai_response=str.strip,
+        llm_text=lambda msg: msg.get("llm_content", msg["content"]),
+        estimate_tokens=lambda text: len(text) // 4,
+    )
+    app.reply = lambda content: app.generate_ollama_response.__globals__.update(
+        ollama_post=lambda backend, payload: FakeResponse(content)
+    )
+    app.reply(SUMMARY_TEXT)
+    return app
+
+
+def long_chat(turns=10):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * 200})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "y" * 200})
+    return {
+        "messages": messages, "history_token_budget": 300, "summary_upto": 0,
+        "summarize_history": True, "history_summary": "earlier summary",
+    }
+
+
+def test_window_moves_when_summary_is_produced(app):
+    state = long_chat()
+    app.update_history_window(state)
+    assert state["summary_upto"] > 0
+    assert state["messages"][state["summary_upto"]]["role"] == "user"
+    assert state["history_summary"] == SUMMARY_TEXT
+
+
+@pytest.mark.parametrize("reply", [requests.HTTPError("500 Server Error"), "", "   "])
+def test_window_stays_when_summarizing_fails(app, reply):
+    app.reply(reply)
+    state = long_chat()
+    app.update_history_window(state)
+    assert state["summary_upto"] == 0
+    assert state["history_summary"] == "earlier summary"
+
+
+def test_window_moves_without_summary_when_disabled(app):
+    state = long_chat()
+    state["summarize_history"] = False
+    app.update_history_window(state)
+    assert state["summary_upto"] > 0
+    assert state["history_summary"] == "earlier summary"
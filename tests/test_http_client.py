@@ -0,0 +1,49 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import load_app
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            SlowHandler.active += 1
+            SlowHandler.peak = max(SlowHandler.peak, SlowHandler.active)
+        time.sleep(0.1)
+        with self.lock:
+            SlowHandler.active -= 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_requests_to_one_host_are_limited_to_the_pool_size(server):
+    app = load_app(
+        "HTTP_POOL_HOSTS", "HTTP_POOL_SIZE", "HTTP_RETRIES", "HTTP_BACKOFF", "OLLAMA_POOL_SIZE", "get_http_session",
+        OLLAMA_BACKEND_SLOTS=2, OLLAMA_HOSTS=[],
+    )
+    session = app.get_http_session()
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        statuses = list(executor.map(lambda _: session.get(server, timeout=5).status_code, range(12)))
+    assert statuses == [200] * 12
+    assert SlowHandler.peak <= app.HTTP_POOL_SIZE
@@ -0,0 +1,93 @@
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture
+def app():
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(owner UNINDEXED, chat_id UNINDEXED, position UNINDEXED, content)")
+    conn.execute("CREATE TABLE message_index (id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, position INTEGER NOT NULL)")
+    conn.execute("CREATE INDEX message_index_chat ON message_index (chat_id, position)")
+
+    @contextmanager
+    def archive_db():
+        with conn:
+            yield conn
+
+    app = load_app(
+        "LOCAL_CONTEXT_K", "LOCAL_SNIPPET_CHARS", "LOCAL_SNIPPET_MIN_COVERAGE", "LOCAL_STOP_WORDS",
+        "TIME_SENSITIVE_WORDS", "live_chat_id", "chat_exchanges", "index_chat_messages", "unindex_chat_messages",
+        "index_live_messages", "forget_live_messages", "query_terms",
+        "term_found", "is_time_sensitive", "search_local_context",
+        archive_db=archive_db, get_archive_index=lambda: True,
+    )
+    app.conn = conn
+    return app
+
+
+def archive(app, question, answer, chat_id="chat-1"):
+    messages = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+    app.index_chat_messages(app.conn, "me", chat_id, messages)
+
+
+def search(app, text, summary_upto=0):
+    return app.search_local_context(text, {"user_id": "me", "conversation_id": "tab", "summary_upto": summary_upto})
+
+
+def test_same_question_skips_web_search(app):
+    archive(app, "Who won the world cup in 2022?", "Argentina won the 2022 world cup.")
+    snippets, enough = search(app, "who won the world cup in 2022")
+    assert enough
+    assert "Argentina" in snippets[0]
+
+
+def test_different_year_still_searches(app):
+    archive(app, "Who won the world cup in 2022?", "Argentina won the 2022 world cup.")
+    snippets, enough = search(app, "Who won the world cup in 2018?")
+    assert not enough
+    assert snippets  # still offered as context
+
+
+def test_filler_words_dont_count_as_matches(app):
+    archive(app, "Question 4 about topic 17?", "Something about topic 17.")
+    assert app.query_terms("Question 9 about topic 31?") == ["question", "9", "topic", "31"]
+    assert not search(app, "Question 9 about topic 31?")[1]
+
+
+def test_time_sensitive_questions_always_search(app):
+    archive(app, "What is the weather in Haifa?", "Sunny in Haifa.")
+    assert not search(app, "What is the weather in Haifa?")[1]
+
+
+def test_other_users_chats_are_not_used(app):
+    app.conn.execute(
+        "INSERT INTO messages_fts (owner, chat_id, position, content) VALUES ('someone', 'x', 0, ?)",
+        ("Q: capital of australia\nA: Canberra",),
+    )
+    assert search(app, "capital of australia") == ([], False)
+
+
+def test_live_chat_is_indexed_incrementally_and_forgotten(app):
+    state = {"user_id": "me", "conversation_id": "tab", "messages": [
+        {"role": "user", "content": "What is the capital of Australia?"},
+        {"role": "assistant", "content": "Canberra."},
+    ]}
+    app.index_live_messages(state)
+    state["messages"] += [
+        {"role": "user", "content": "And the capital of Canada?"},
+        {"role": "assistant", "content": "Ottawa."},
+    ]
+    app.index_live_messages(state)
+    rows = app.conn.execute("SELECT chat_id, position FROM message_index ORDER BY position").fetchall()
+    assert [tuple(row) for row in rows] == [("live:tab", 0), ("live:tab", 2)]
+    assert app.conn.execute("SELECT COUNT(*) FROM messages_fts").fetchone()[0] == 2
+    assert search(app, "capital of canada", summary_upto=4)[1]
+
+    app.forget_live_messages("tab")
+    assert app.conn.execute("SELECT COUNT(*) FROM messages_fts").fetchone()[0] == 0
+    assert app.conn.execute("SELECT COUNT(*) FROM message_index").fetchone()[0] == 0
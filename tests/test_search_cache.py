@@ -0,0 +1,44 @@
+from conftest import load_app
+
+app = load_app("normalize_query")
+
+
+def test_case_spacing_and_closing_punctuation_are_folded():
+    assert app.normalize_query("  Weather   in Paris?? ") == app.normalize_query("weather in paris")
+
+
+def test_symbols_and_short_words_are_kept():
+    assert app.normalize_query("C++ tutorial") != app.normalize_query("C tutorial")
+    assert app.normalize_query("The Who") != app.normalize_query("who")
+
+
+def test_punctuation_only_query_keeps_its_text():
+    assert app.normalize_query("???") == "???"
+
+
+def make_cache(tmp_path):
+    cache_app = load_app("TTLCache")
+    return cache_app.TTLCache(10, ttl=60, disk_dir=tmp_path)
+
+
+def test_disk_entries_survive_a_restart(tmp_path):
+    make_cache(tmp_path).put("weather in paris", "Sunny")
+    assert make_cache(tmp_path).get("weather in paris") == ("Sunny", True)
+
+
+def test_concurrent_writes_of_one_key(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = make_cache(tmp_path)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.put("same query", f"result {i}"), range(200)))
+    assert cache.get("same query")[0].startswith("result ")
+    assert len(list(tmp_path.glob("*.json"))) == 1
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_disk_errors_keep_the_value_in_memory(tmp_path):
+    cache = make_cache(tmp_path / "cache")
+    (tmp_path / "cache").rmdir()  # every write to disk now fails
+    cache.put("weather in paris", "Sunny")
+    assert cache.get("weather in paris") == ("Sunny", True)
@@ -0,0 +1,79 @@
+import pytest
+
+from conftest import load_app
+
+app = load_app("SCRIPT_LANGUAGES", "ENGLISH_HINT_WORDS", "ENGLISH_MIN_WORDS", "detect_language")
+
+
+@pytest.mark.parametrize("text", [
+    "Was ist das?",
+    "Was machst du heute?",
+    "me gusta a mi",
+    "in casa con la mamma",
+    "Is het in orde?",
+    "Dove sei tu in Italia",
+    "Je pense que c'est une bonne idée",
+    "hello there",
+])
+def test_other_languages_are_left_to_the_translator(text):
+    assert app.detect_language(text) is None
+
+
+@pytest.mark.parametrize("text", [
+    "What is the capital of Australia?",
+    "How are you doing today?",
+    "Tell me about the history of Rome",
+    "Who won the world cup in 2022?",
+])
+def test_plain_english_is_detected(text):
+    assert app.detect_language(text) == "en"
+
+
+def test_non_latin_scripts():
+    assert app.detect_language("Привет, как дела?") == "ru"
+    assert app.detect_language("Καλημέρα σας") == "el"
+
+
+class FakeExecutor:
+    def map(self, fn, items):
+        return [fn(item) for item in items]
+
+
+@pytest.fixture
+def translator():
+    sent = []
+
+    def translate_text(text, target, source="auto"):
+        sent.append(text)
+        return text.upper() if text.strip() else text
+
+    translator = load_app(
+        "TRANSLATION_CHUNK_CHARS", "CODE_FENCE", "translate_long_text",
+        detect_language=lambda text: None, translate_text=translate_text,
+        get_translation_executor=FakeExecutor,
+    )
+    translator.sent = sent
+    return translator
+
+
+def test_code_blocks_with_blank_lines_stay_whole(translator):
+    code = "```python\nimport x\n\nprint(1)\n```"
+    text = f"Here is the code.\n\n{code}\n\nRun it twice."
+    assert translator.translate_long_text(text, "fr") == f"HERE IS THE CODE.\n\n{code}\n\nRUN IT TWICE."
+    assert not any("print" in sent or "```" in sent for sent in translator.sent)
+
+
+def test_code_block_right_after_a_sentence(translator):
+    text = "Try this:\n```\na = 1\n\nb = 2\n```\nDone.\n\nBye."
+    assert translator.translate_long_text(text, "fr") == "TRY THIS:\n```\na = 1\n\nb = 2\n```\nDONE.\n\nBYE."
+
+
+def test_unclosed_code_block_is_left_alone(translator):
+    text = "Start:\n\n```\nx = 1\n\ny = 2"
+    assert translator.translate_long_text(text, "fr") == "START:\n\n```\nx = 1\n\ny = 2"
+
+
+def test_long_paragraphs_are_split_for_the_api(translator):
+    text = "word " * 2000 + "\n\nshort"
+    translator.translate_long_text(text, "fr")
+    assert max(len(sent) for sent in translator.sent) <= translator.TRANSLATION_CHUNK_CHARS
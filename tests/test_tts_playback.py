@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture
+def app():
+    return load_app("MP3_KBPS", "mp3_duration")
+
+
+def test_duration_from_frame_header(app):
+    # MPEG-2 layer III at 32 kbps, 24 kHz mono: what gTTS returns
+    frame = b"\xff\xf3\x44\xc4" + b"\0" * 140
+    audio = frame * 28
+    assert app.mp3_duration(audio) == pytest.approx(len(audio) * 8 / 32000)
+
+
+def test_id3_tag_is_skipped(app):
+    tag = b"ID3\x04\x00\x00\x00\x00\x00\x10" + b"\xff" * 16  # tag body that looks like a frame sync
+    audio = tag + b"\xff\xfb\x90\x64" + b"\0" * 3996  # MPEG-1 layer III at 128 kbps
+    assert app.mp3_duration(audio) == pytest.approx(4000 * 8 / 128000)
+
+
+def test_unknown_data_falls_back_to_32_kbps(app):
+    assert app.mp3_duration(b"\0" * 8000) == pytest.approx(2.0)
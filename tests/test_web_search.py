@@ -0,0 +1,121 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from conftest import load_app
+
+parser_app = load_app("ResultParser")
+
+
+def parse(html, class_lists=("VwiC3b",), limit=10, chunk=None):
+    parser = parser_app.ResultParser(class_lists, limit)
+    for i in range(0, len(html), chunk or len(html)):
+        parser.feed(html[i:i + (chunk or len(html))])
+        if parser.done:
+            break
+    return parser
+
+
+GOOGLE_PAGE = """
+<html><body>
+<div class="g"><div class="VwiC3b">First <b>result</b> text</div></div>
+<div class="g"><div class="VwiC3b"><div>Nested <span>second</span></div> result</div></div>
+<div class="dbsr"><a href="https://example.com/news">A headline</a></div>
+<div class="g"><div class="VwiC3b">Third &amp; last</div></div>
+</body></html>
+"""
+
+
+def test_extracts_text_of_matching_elements():
+    assert parse(GOOGLE_PAGE).results == [
+        ("First result text", None),
+        ("Nested second result", None),
+        ("Third & last", None),
+    ]
+
+
+def test_first_link_inside_a_result_is_kept():
+    assert parse(GOOGLE_PAGE, class_lists=("dbsr",)).results == [("A headline", "https://example.com/news")]
+
+
+def test_results_survive_omitted_end_tags():
+    html = (
+        '<div class="VwiC3b"><p>one<br> two</div>'
+        '<div class="VwiC3b"><ul><li>three <li>four</ul></div>'
+        '<div class="VwiC3b">five</div>'
+    )
+    parser = parse(html)
+    assert [text for text, _ in parser.results] == ["one two", "three four", "five"]
+    assert parser.depth == 0
+
+
+def test_matched_element_without_end_tag_ends_at_the_next_one():
+    parser = parse('<ul><li class="hit">first<li class="hit">second</ul>', class_lists=("hit",))
+    assert [text for text, _ in parser.results] == ["first"]  # the last <li> is never closed
+
+
+def test_stops_at_the_limit_and_across_chunk_boundaries():
+    parser = parse(GOOGLE_PAGE, limit=2, chunk=7)
+    assert parser.done
+    assert [text for text, _ in parser.results] == ["First result text", "Nested second result"]
+
+
+def test_class_lists_need_every_class():
+    html = '<div class="BNeawe s3v9rd AP7Wnd">yes</div><div class="BNeawe">no</div>'
+    assert parse(html, class_lists=("BNeawe s3v9rd AP7Wnd",)).results == [("yes", None)]
+
+
+@pytest.fixture
+def search():
+    pages = {}
+
+    def fetch_results(url, class_lists, limit, deadline):
+        outcome = pages[url]
+        if callable(outcome):
+            return outcome()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return [(text, None) for text in outcome[:limit]]
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    app = load_app(
+        "fetch_web_search",
+        SEARCH_ENGINES={"google": ("g", ()), "duckduckgo": ("d", ())},
+        SEARCH_SOURCES=[("google", "g"), ("duckduckgo", "d")],
+        SEARCH_RESULTS=3, SEARCH_DEADLINE=0.5,
+        get_search_executor=lambda: executor, fetch_results=fetch_results,
+        search_url=lambda url, query: url,
+    )
+    app.pages = pages
+    yield app
+    executor.shutdown(wait=False)
+
+
+def test_sources_are_merged_round_robin_without_duplicates(search):
+    search.pages.update(g=["G1", "Shared", "G3"], d=["shared", "D2", "D3"])
+    assert search.fetch_web_search("q") == "Web search results:\n- G1\n- shared\n- D2"
+
+
+def test_failed_source_is_left_out(search):
+    search.pages.update(g=requests.ConnectionError("down"), d=["D1", "D2"])
+    assert search.fetch_web_search("q") == "Web search results:\n- D1\n- D2"
+
+
+def test_slow_source_is_dropped_at_the_deadline(search):
+    search.pages.update(g=lambda: time.sleep(2) or [("late", None)], d=["D1"])
+    started = time.monotonic()
+    assert search.fetch_web_search("q") == "Web search results:\n- D1"
+    assert time.monotonic() - started < 1.5
+
+
+def test_error_is_raised_when_every_source_fails(search):
+    search.pages.update(g=requests.ConnectionError("down"), d=requests.Timeout("slow"))
+    with pytest.raises(requests.ConnectionError):
+        search.fetch_web_search("q")
+
+
+def test_no_results(search):
+    search.pages.update(g=[], d=[])
+    assert search.fetch_web_search("q") == "Web search found no results."